@@ -9,6 +9,8 @@ from datetime import datetime
 
 cdir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(cdir)
+sys.path.append(os.path.dirname(cdir))
+from tracking.store import load_coordinates
 from utils.heatmaps import HeatMapAnalyzer
 from utils.ball import BallPossessionAnalyzer
 from utils.control import SpaceControlAnalyzer
@@ -238,8 +240,7 @@ def heatmap_integrate(data):
 
 
 def integrate(pkl_path, out_path, config_path=f'{cdir}/config/config.yaml'):
-    with open(pkl_path, 'rb') as f:
-        _, data = pickle.load(f)
+    data = load_coordinates(pkl_path)
 
     with open(config_path, 'r') as f:
         config = yaml.safe_load(f)
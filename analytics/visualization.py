@@ -1,7 +1,6 @@
 import os
 import sys
 import yaml
-import pickle
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -11,6 +10,8 @@ from scipy.spatial import Voronoi
 
 cdir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(cdir)
+sys.path.append(os.path.dirname(cdir))
+from tracking.store import load_coordinates
 from utils.heatmaps import HeatMapAnalyzer
 from utils.distance import DistanceAnalyzer
 from utils.ball import BallPossessionAnalyzer
@@ -215,8 +216,7 @@ def heat_map_visualization(data, times = None, save_path = None, show = True):
         
 
 def visualize(pkl_path, statistic, player_id=None, frame_id=None, times=None, save_path=None, show=True, config_path=f'{cdir}/config/config.yaml'):    
-    with open(pkl_path, 'rb') as f:
-        _, data = pickle.load(f)
+    data = load_coordinates(pkl_path)
 
     with open(config_path, 'r') as f:
         config = yaml.safe_load(f)
@@ -2,7 +2,8 @@ import os
 import argparse
 
 import tracking.interpolate as interpolate
-from tracking.detect import detections
+from tracking.detect import DetectionConfig, detections
+from tracking.shard import sharded_detections
 from tracking.draw import draw_markers, draw_minimap
 from analytics.visualization import visualize
 
@@ -30,11 +31,16 @@ if __name__ == '__main__':
         default=f'{cdir}/models/ball.pt', 
         help='Path to the ball model',
     )
+    parser.add_argument(
+        '--combined', 
+        action='store_true', 
+        help='Detect the ball with the players model instead of a separate ball model'
+    )
     parser.add_argument(
         '--detections_path', 
         type=str, 
         default=f'{cdir}/results/trimmed/detections_trimmed.pkl', 
-        help='Path to the detections pkl file',
+        help='Path to the detections pkl file, or to a store directory if it does not end with .pkl',
     )
     parser.add_argument(
         '--analyze_path',
@@ -66,6 +72,190 @@ if __name__ == '__main__':
         default=0.5, 
         help='Confidence level for ball'
     )
+    parser.add_argument(
+        '--batch_size', 
+        type=int, 
+        default=1, 
+        help='Number of frames sent to the detection models at once'
+    )
+    parser.add_argument(
+        '--threaded', 
+        action='store_true', 
+        help='Run decoding, inference and tracking in separate threads'
+    )
+    parser.add_argument(
+        '--workers', 
+        type=int, 
+        default=1, 
+        help='Number of inference threads when threaded'
+    )
+    parser.add_argument(
+        '--queue_size', 
+        type=int, 
+        default=4, 
+        help='Number of batches held between the threaded stages'
+    )
+    parser.add_argument(
+        '--team_cache', 
+        action='store_true', 
+        help='Remember the team of each tracking id instead of classifying every frame'
+    )
+    parser.add_argument(
+        '--team_backend', 
+        type=str, 
+        default='siglip', 
+        choices=['siglip', 'color'], 
+        help='Features used to separate the teams, SigLIP embeddings or shirt colors'
+    )
+    parser.add_argument(
+        '--single_pass', 
+        action='store_true', 
+        help='Fit the team classifier on the first frames of the main loop instead of a separate pass'
+    )
+    parser.add_argument(
+        '--warmup', 
+        type=float, 
+        default=10, 
+        help='Seconds of video used to fit the team classifier with single_pass'
+    )
+    parser.add_argument(
+        '--max_samples', 
+        type=int, 
+        default=None, 
+        help='Maximum number of frames sampled to fit the team classifier'
+    )
+    parser.add_argument(
+        '--chunk_size', 
+        type=int, 
+        default=1000, 
+        help='Number of frames in each chunk of the store'
+    )
+    parser.add_argument(
+        '--checkpoint', 
+        action='store_true', 
+        help='Save the state of the run every chunk_size frames'
+    )
+    parser.add_argument(
+        '--resume', 
+        action='store_true', 
+        help='Restart the detections from the last checkpoint'
+    )
+    parser.add_argument(
+        '--backend', 
+        type=str, 
+        default='torch', 
+        choices=['torch', 'onnx', 'openvino'], 
+        help='Runtime of the detection and calibration models, the exported ones run on the CPU'
+    )
+    parser.add_argument(
+        '--threads', 
+        type=int, 
+        default=None, 
+        help='Number of CPU threads used by the PyTorch models and the exported calibration models'
+    )
+    parser.add_argument(
+        '--quantized', 
+        action='store_true', 
+        help='Use the INT8 calibration models with the onnx or openvino backend'
+    )
+    parser.add_argument(
+        '--detect_stride', 
+        type=int, 
+        default=1, 
+        help='Run the detection models on one frame every detect_stride frames'
+    )
+    parser.add_argument(
+        '--ball_roi', 
+        action='store_true', 
+        help='Search the ball around its predicted position instead of the whole frame'
+    )
+    parser.add_argument(
+        '--ball_window', 
+        type=int, 
+        default=640, 
+        help='Size in pixels of the window the ball is searched in'
+    )
+    parser.add_argument(
+        '--ball_misses', 
+        type=int, 
+        default=5, 
+        help='Number of frames the ball is missed before the whole frame is searched'
+    )
+    parser.add_argument(
+        '--ball_tiles', 
+        action='store_true', 
+        help='Search the whole frame for the ball in overlapping tiles of the pitch'
+    )
+    parser.add_argument(
+        '--tile_size', 
+        type=int, 
+        default=640, 
+        help='Size in pixels of the tiles the ball is searched in'
+    )
+    parser.add_argument(
+        '--tile_overlap', 
+        type=float, 
+        default=0.2, 
+        help='Fraction of a tile that overlaps the next one'
+    )
+    parser.add_argument(
+        '--scenes', 
+        action='store_true', 
+        help='Skip the frames that do not show the pitch and drop the tracks on cuts'
+    )
+    parser.add_argument(
+        '--min_green', 
+        type=float, 
+        default=0.3, 
+        help='Fraction of green pixels above which a frame shows the pitch'
+    )
+    parser.add_argument(
+        '--pitch_filter', 
+        action='store_true', 
+        help='Run the detection models on the pitch only and drop the players standing off it, not with threaded'
+    )
+    parser.add_argument(
+        '--pitch_margin', 
+        type=float, 
+        default=3., 
+        help='Meters around the pitch kept by the pitch filter'
+    )
+    parser.add_argument(
+        '--shards', 
+        type=int, 
+        default=1, 
+        help='Number of processes to split the video between'
+    )
+    parser.add_argument(
+        '--overlap', 
+        type=int, 
+        default=50, 
+        help='Number of frames shared by consecutive shards'
+    )
+    parser.add_argument(
+        '--calib_mode', 
+        type=str, 
+        default='full', 
+        choices=['full', 'fast', 'temporal'],
+        help='Camera calibration mode'
+    )
+    parser.add_argument(
+        '--motion_gated', 
+        action='store_true', 
+        help='Calibrate the camera only on keyframes and follow it with optical flow in between'
+    )
+    parser.add_argument(
+        '--key_interval', 
+        type=int, 
+        default=25, 
+        help='Maximum number of frames between keyframes when motion gated'
+    )
+    parser.add_argument(
+        '--max_drift', 
+        type=float, 
+        default=5., 
+        help='Maximum optical flow drift in pixels between keyframes when motion gated'
+    )
     parser.add_argument(
         '--project', 
         action='store_false', 
@@ -131,6 +321,10 @@ if __name__ == '__main__':
     players_path = args.players_path
     ball_path = args.ball_path
 
+    # set combined to run a single model trained on the ball, players, goalkeepers and referees
+    if args.combined:
+        ball_path = None
+
     # path to the output files
     # change according to your needs
     detections_path = args.detections_path
@@ -141,16 +335,48 @@ if __name__ == '__main__':
     # run the detections on the video
     # set individual confidence levels for players and ball using players_conf and ball_conf
     # set project to False if you do not want to project the detections to the 2D plane
-    detections(
-        clip_path, 
-        players_path, 
-        ball_path, 
-        detections_path, 
-        players_conf=args.players_conf,
-        ball_conf=args.ball_conf,
-        project=args.project,
-        verbose=args.verbose,
-    )
+    # set batch_size to run the detection models on several frames at once
+    # set threaded to overlap decoding, inference and tracking, with workers inference threads
+    # set calib_mode to fast to calibrate with a single homography instead of voting
+    # or to temporal to start the calibration of each frame from the previous one
+    # set motion_gated to skip the calibration on frames where the camera barely moves
+    # set team_cache to classify each tracking id only until its team is known
+    # set team_backend to 'color' to separate the teams by shirt colors instead of SigLIP
+    # set single_pass to fit the team classifier on the first warmup seconds so every frame is decoded once
+    # set max_samples to cap the number of frames the team classifier is fitted on
+    # set detections_path to a directory instead of a pkl file to write a store in chunks of chunk_size frames
+    # set checkpoint to save the state of the run every chunk_size frames and resume to restart from it
+    # set backend to 'onnx' or 'openvino' to run exported models on the CPU, threads does not apply to the exported detectors
+    # set quantized to use the INT8 calibration models built by tracking/utils/quantize.py
+    # set detect_stride to detect every few frames and follow the boxes with optical flow in between
+    # set ball_roi to search the ball in a window around its predicted position
+    # set ball_tiles to search the whole frame for the ball in tiles at full resolution
+    # set scenes to skip close-ups, replays and graphics, the tags are used to interpolate the ball
+    # set pitch_filter to crop the frames to the calibrated pitch and drop the boxes more than pitch_margin meters off it
+    # set shards to split the video between several processes, overlap frames are used to join the tracks
+    # the options are read from the arguments with the same names as the fields of DetectionConfig
+    config = DetectionConfig.from_args(args)
+
+    if args.shards > 1:
+        sharded_detections(
+            clip_path, 
+            players_path, 
+            ball_path, 
+            detections_path, 
+            config,
+            shards=args.shards,
+            overlap=args.overlap,
+        )
+    else:
+        detections(
+            clip_path, 
+            players_path, 
+            ball_path, 
+            detections_path, 
+            config,
+            checkpoint=args.checkpoint,
+            resume=args.resume,
+        )
 
     # draw the detections on the video
     draw_markers(clip_path, markers_path, detections_path)
@@ -0,0 +1,856 @@
+import os
+import sys
+import cv2
+import copy
+import time
+import argparse
+import tempfile
+import numpy as np
+import supervision as sv
+
+from ultralytics import YOLO
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from detect import DetectionConfig, detections, detect_frames, extract_crops, sample_frames, BALL_ID, PLAYER_ID
+from store import load_coordinates
+from utils.team import TeamClassifier, create_batches
+from utils.calib import FramebyFrameCalib
+from utils.homography import CalibrationEngine, PitchFilter, detect_keypoints, frame_tensor, frames_tensor, project, load_models
+from utils import heatmap
+from utils.backend import BACKENDS, load_detector, set_threads
+from utils.ball_search import BallSearch, pitch_tiles, tiled_detections
+
+cdir = os.path.dirname(os.path.abspath(__file__))
+
+
+def detection_throughput(clip_path, players_path, ball_path, batch_sizes=(1, 4, 8, 16), max_frames=None):
+    """
+    Measures the frames per second of the detection models for each batch size.
+
+    Decoding is included in the timing since it is part of every run.
+    """
+    players_model = YOLO(players_path)
+    ball_model = YOLO(ball_path)
+
+    # warm up the models so the first batch size is not penalized
+    frame = next(sv.get_video_frames_generator(clip_path))
+    detect_frames([frame], players_model, ball_model)
+
+    report = {}
+    for batch_size in batch_sizes:
+        frame_generator = sv.get_video_frames_generator(clip_path, end=max_frames)
+
+        frames = 0
+        start = time.perf_counter()
+        for batch in create_batches(frame_generator, batch_size):
+            detect_frames(batch, players_model, ball_model)
+            frames += len(batch)
+        elapsed = time.perf_counter() - start
+
+        report[batch_size] = frames / elapsed
+
+    return report
+
+
+def calibration_modes(clip_path, stride=25, max_frames=None, grid=8):
+    """
+    Compares the fast and full calibration modes on the same keypoints.
+
+    Reports the mean time per frame to fit the projection in each mode and the
+    mean distance in meters between the minimap positions of a grid of image points.
+    """
+    engine = CalibrationEngine()
+
+    times = {'full': [], 'fast': []}
+    errors = []
+
+    frame_generator = sv.get_video_frames_generator(
+        clip_path, stride=stride, end=max_frames)
+    for frame in frame_generator:
+        h, w = frame.shape[:2]
+
+        # detect the keypoints once and fit them with both modes
+        keypoints = detect_keypoints(
+            frame,
+            engine.model,
+            engine.model_l,
+            engine.kp_threshold,
+            engine.line_threshold,
+            device=engine.device,
+        )
+        engine.cam = FramebyFrameCalib(iwidth=w, iheight=h, denormalize=True)
+        engine.cam.update(keypoints)
+
+        projections = {}
+        for mode in ['full', 'fast']:
+            engine.mode = mode
+            start = time.perf_counter()
+            projections[mode] = engine.fit()
+            times[mode].append(time.perf_counter() - start)
+
+        if projections['full'] is None or projections['fast'] is None:
+            continue
+
+        # boxes with their bottom center on a grid over the lower half of the frame
+        xs, ys = np.meshgrid(
+            np.linspace(0, w, grid), np.linspace(h / 2, h, grid))
+        coords = [(x, y, x, y) for x, y in zip(xs.ravel(), ys.ravel())]
+
+        full, _ = project(projections['full'], coords, h, w)
+        fast, _ = project(projections['fast'], coords, h, w)
+
+        distance = (np.array(full) - np.array(fast)) * [105, 68]
+        errors.append(np.linalg.norm(distance, axis=1).mean())
+
+    return {
+        'full ms': 1000 * np.mean(times['full']),
+        'fast ms': 1000 * np.mean(times['fast']),
+        'fallbacks': engine.fallbacks,
+        'position error m': np.mean(errors) if errors else np.nan,
+    }
+
+
+def temporal_calibration(clip_path, max_frames=250):
+    """
+    Compares the full and temporal calibration modes on consecutive frames.
+
+    Reports the mean solver time per frame and the jitter of the camera, the standard
+    deviation of the frame to frame change of pan, tilt and focal length.
+    """
+    engine = CalibrationEngine()
+
+    keypoints = []
+    frame_generator = sv.get_video_frames_generator(clip_path, end=max_frames)
+    for frame in frame_generator:
+        h, w = frame.shape[:2]
+        keypoints.append(detect_keypoints(
+            frame,
+            engine.model,
+            engine.model_l,
+            engine.kp_threshold,
+            engine.line_threshold,
+            device=engine.device,
+        ))
+
+    report = {}
+    for mode in ['full', 'temporal']:
+        engine.mode = mode
+        engine.params = None
+        engine.cam = FramebyFrameCalib(iwidth=w, iheight=h, denormalize=True)
+
+        times = []
+        params = []
+        for frame_keypoints in keypoints:
+            # update denormalizes the keypoints in place
+            engine.cam.update(copy.deepcopy(frame_keypoints))
+
+            start = time.perf_counter()
+            engine.fit()
+            times.append(time.perf_counter() - start)
+
+            if engine.params is not None:
+                cam_params = engine.params['cam_params']
+                params.append([
+                    cam_params['pan_degrees'],
+                    cam_params['tilt_degrees'],
+                    cam_params['x_focal_length'],
+                ])
+
+        jitter = np.diff(np.array(params), axis=0).std(axis=0)
+        report[f'{mode} solver ms'] = 1000 * np.mean(times)
+        report[f'{mode} pan jitter deg'] = jitter[0]
+        report[f'{mode} tilt jitter deg'] = jitter[1]
+        report[f'{mode} focal jitter px'] = jitter[2]
+
+    return report
+
+
+def team_backends(clip_path, players_path, max_frames=None):
+    """
+    Compares the siglip and color team classifier backends on the same crops.
+
+    Both are fitted on the crops of a frame from every second of the clip. Reports
+    the time to load, fit and predict with each backend, and the fraction of the crops
+    put in the same team by both, taking the best of the two ways to match the labels.
+    """
+    players_model = YOLO(players_path)
+    video_info = sv.VideoInfo.from_video_path(clip_path)
+    crops = extract_crops(
+        players_model, clip_path, video_info.fps, PLAYER_ID, end=max_frames)
+
+    report = {'crops': len(crops)}
+    predictions = {}
+    for backend in ['siglip', 'color']:
+        start = time.perf_counter()
+        team_classifier = TeamClassifier(backend=backend)
+        load = time.perf_counter() - start
+
+        start = time.perf_counter()
+        team_classifier.fit(crops)
+        fit = time.perf_counter() - start
+
+        start = time.perf_counter()
+        predictions[backend] = team_classifier.predict(crops)
+        predict = time.perf_counter() - start
+
+        report[f'{backend} load s'] = load
+        report[f'{backend} fit s'] = fit
+        report[f'{backend} predict ms/crop'] = 1000 * predict / len(crops)
+
+    # the cluster labels are arbitrary, so the labels may be swapped between backends
+    agreement = np.mean(predictions['siglip'] == predictions['color'])
+    report['agreement'] = max(agreement, 1 - agreement)
+
+    return report
+
+
+def frame_sampling(clip_path, max_samples=None):
+    """
+    Compares the time to read a frame from every second of the clip by decoding it
+    with a stride and by skipping to the sampled frames.
+    """
+    video_info = sv.VideoInfo.from_video_path(clip_path)
+
+    start = time.perf_counter()
+    strided = sum(1 for _ in sv.get_video_frames_generator(
+        clip_path, stride=video_info.fps))
+    strided_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sampled = sum(1 for _ in sample_frames(
+        clip_path, video_info.fps, max_samples=max_samples))
+    sampled_time = time.perf_counter() - start
+
+    return {
+        'stride frames': strided,
+        'stride s': strided_time,
+        'sampled frames': sampled,
+        'sampled s': sampled_time,
+    }
+
+
+def inference_backends(clip_path, players_path, ball_path, max_frames=50, threads=None):
+    """
+    Measures the frames per second of each model on the CPU with every backend.
+
+    The models are exported before the timing starts, so only the inference is measured.
+    """
+    import torch
+
+    set_threads(threads)
+    frames = list(sv.get_video_frames_generator(clip_path, end=max_frames))
+    inputs = torch.rand(1, 3, 540, 960)
+
+    report = {}
+    for backend in BACKENDS:
+        detectors = {
+            'players': load_detector(players_path, backend),
+            'ball': load_detector(ball_path, backend),
+        }
+        for name, model in detectors.items():
+            model(frames[0], device='cpu', verbose=False)
+            start = time.perf_counter()
+            for frame in frames:
+                model(frame, device='cpu', verbose=False)
+            report[f'{name} {backend}'] = len(frames) / (time.perf_counter() - start)
+
+        model, model_l = load_models(torch.device('cpu'), backend, threads)
+        for name, calibration_model in [('keypoints', model), ('lines', model_l)]:
+            with torch.no_grad():
+                calibration_model(inputs)
+                start = time.perf_counter()
+                for _ in frames:
+                    calibration_model(inputs)
+            report[f'{name} {backend}'] = len(frames) / (time.perf_counter() - start)
+
+    return report
+
+
+def quantized_calibration(clip_path, stride=25, max_frames=None, grid=8, threads=None):
+    """
+    Compares the FP32 and INT8 keypoint and line models exported to ONNX.
+
+    Reports the time per frame of the models, the number of keypoints found by each,
+    the mean distance in pixels between the keypoints found by both and the mean distance
+    in meters between the minimap positions of a grid of image points.
+    """
+    import torch
+
+    engine = CalibrationEngine(backend='onnx', threads=threads)
+    models = {
+        'fp32': (engine.model, engine.model_l),
+        'int8': load_models(torch.device('cpu'), 'onnx', threads, quantized=True),
+    }
+
+    times = {'fp32': [], 'int8': []}
+    counts = {'fp32': [], 'int8': []}
+    distances = []
+    errors = []
+
+    frame_generator = sv.get_video_frames_generator(
+        clip_path, stride=stride, end=max_frames)
+    for frame in frame_generator:
+        h, w = frame.shape[:2]
+
+        keypoints = {}
+        projections = {}
+        for name, (model, model_l) in models.items():
+            start = time.perf_counter()
+            keypoints[name] = detect_keypoints(
+                frame,
+                model,
+                model_l,
+                engine.kp_threshold,
+                engine.line_threshold,
+                device=engine.device,
+            )
+            times[name].append(time.perf_counter() - start)
+            counts[name].append(len(keypoints[name]))
+
+            engine.cam = FramebyFrameCalib(iwidth=w, iheight=h, denormalize=True)
+            engine.cam.update(copy.deepcopy(keypoints[name]))
+            projections[name] = engine.fit()
+
+        for i in set(keypoints['fp32']) & set(keypoints['int8']):
+            fp32, int8 = keypoints['fp32'][i], keypoints['int8'][i]
+            distances.append(np.hypot(
+                (fp32['x'] - int8['x']) * w, (fp32['y'] - int8['y']) * h))
+
+        if projections['fp32'] is None or projections['int8'] is None:
+            continue
+
+        xs, ys = np.meshgrid(
+            np.linspace(0, w, grid), np.linspace(h / 2, h, grid))
+        coords = [(x, y, x, y) for x, y in zip(xs.ravel(), ys.ravel())]
+
+        fp32, _ = project(projections['fp32'], coords, h, w)
+        int8, _ = project(projections['int8'], coords, h, w)
+
+        distance = (np.array(fp32) - np.array(int8)) * [105, 68]
+        errors.append(np.linalg.norm(distance, axis=1).mean())
+
+    return {
+        'fp32 ms': 1000 * np.mean(times['fp32']),
+        'int8 ms': 1000 * np.mean(times['int8']),
+        'fp32 keypoints': np.mean(counts['fp32']),
+        'int8 keypoints': np.mean(counts['int8']),
+        'keypoint error px': np.mean(distances) if distances else np.nan,
+        'position error m': np.mean(errors) if errors else np.nan,
+    }
+
+
+def minimap_error(reference, coordinates):
+    """
+    Returns the mean distance in meters between the minimap positions of the players
+    in two runs over the same frames.
+
+    The tracking ids of two runs differ, so the players of every frame are paired
+    to minimize the total distance.
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    errors = []
+    for (reference_coords, _), (coords, _) in zip(reference, coordinates):
+        reference_xy = np.array([xy for i, _, xy in reference_coords if i != -1]).reshape(-1, 2)
+        xy = np.array([xy for i, _, xy in coords if i != -1]).reshape(-1, 2)
+        if len(reference_xy) == 0 or len(xy) == 0:
+            continue
+
+        distance = np.linalg.norm(
+            (reference_xy[:, None] - xy[None]) * [105, 68], axis=-1)
+        rows, cols = linear_sum_assignment(distance)
+        errors.append(distance[rows, cols].mean())
+
+    return np.mean(errors) if errors else np.nan
+
+
+def detection_stride(clip_path, players_path, ball_path, strides=(1, 2, 3, 5), max_frames=250):
+    """
+    Measures the frames per second of the detections with each detect_stride, and the
+    mean distance between the minimap positions of the players and the ones found
+    when every frame is detected.
+    """
+    report = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for stride in strides:
+            pkl_path = f'{tmp_dir}/stride_{stride}.pkl'
+
+            start = time.perf_counter()
+            detections(
+                clip_path,
+                players_path,
+                ball_path,
+                pkl_path,
+                DetectionConfig(detect_stride=stride),
+                end=max_frames,
+            )
+            elapsed = time.perf_counter() - start
+
+            coordinates = load_coordinates(pkl_path)
+            if stride == strides[0]:
+                reference = coordinates
+
+            report[stride] = (
+                len(coordinates) / elapsed,
+                minimap_error(reference, coordinates),
+            )
+
+    return report
+
+
+def ball_search(clip_path, ball_path, max_frames=250):
+    """
+    Compares detecting the ball in the whole frame and searching it around its predicted position.
+
+    Reports the time per frame and the fraction of the frames the ball is found in.
+    """
+    ball_model = YOLO(ball_path)
+    frames = list(sv.get_video_frames_generator(clip_path, end=max_frames))
+
+    searches = {
+        'full': lambda frame: sv.Detections.from_ultralytics(
+            ball_model(frame, conf=0.5, verbose=False)[0]),
+        'roi': BallSearch(ball_model),
+    }
+
+    report = {}
+    for name, search in searches.items():
+        found = 0
+        start = time.perf_counter()
+        for frame in frames:
+            found += len(search(frame)) > 0
+        elapsed = time.perf_counter() - start
+
+        report[f'{name} ms'] = 1000 * elapsed / len(frames)
+        report[f'{name} found'] = found / len(frames)
+
+    return report
+
+
+def calibration_batches(clip_path, batch_sizes=(1, 4, 8), max_frames=100):
+    """
+    Measures the frames per second of the calibration for each batch size.
+
+    The keypoint and line models run once per batch and the camera is solved frame by frame.
+    Reports the frames per second and the time per frame in the models and in the solver.
+    """
+    frames = list(sv.get_video_frames_generator(clip_path, end=max_frames))
+
+    # warm up the models so the first batch size is not penalized
+    engine = CalibrationEngine()
+    engine.calibrate(frames[0])
+
+    report = {}
+    for batch_size in batch_sizes:
+        engine.cam = None
+        engine.frame_times, engine.fit_times = [], []
+
+        start = time.perf_counter()
+        for batch in create_batches(frames, batch_size):
+            engine.calibrate_batch(batch)
+        elapsed = time.perf_counter() - start
+
+        fit_time = sum(engine.fit_times) / len(frames)
+        report[batch_size] = (
+            len(frames) / elapsed,
+            1000 * (elapsed / len(frames) - fit_time),
+            1000 * fit_time,
+        )
+
+    return report
+
+
+def calibration_preprocessing(clip_path, batch_size=4, max_frames=100):
+    """
+    Compares preparing the inputs of the calibration models with PIL and torchvision,
+    as before, and with frames_tensor writing to a reused buffer.
+
+    Reports the time per frame, the number of tensors allocated per frame, the peak memory
+    allocated outside torch (PIL and NumPy) and the largest difference between the inputs.
+    """
+    import tracemalloc
+    import torch
+    import torchvision.transforms as T
+    import torchvision.transforms.functional as F
+    from PIL import Image
+    from torch.profiler import profile, ProfilerActivity
+
+    frames = list(sv.get_video_frames_generator(clip_path, end=max_frames))
+    buffer = torch.empty((batch_size, 3, 540, 960))
+
+    def pil(batch):
+        return torch.cat([
+            T.Resize((540, 960))(F.to_tensor(Image.fromarray(frame)).float().unsqueeze(0))
+            for frame in batch
+        ])
+
+    def buffered(batch):
+        return frames_tensor(batch, buffer)
+
+    report = {}
+    for name, convert in [('pil', pil), ('buffer', buffered)]:
+        # first call outside the timing so the lazy initializations are not counted
+        convert(frames[:batch_size])
+
+        start = time.perf_counter()
+        for batch in create_batches(frames, batch_size):
+            convert(batch)
+        report[f'{name} ms'] = 1000 * (time.perf_counter() - start) / len(frames)
+
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            for batch in create_batches(frames[:8 * batch_size], batch_size):
+                convert(batch)
+        allocations = sum(1 for e in prof.events() if e.self_cpu_memory_usage > 0)
+        report[f'{name} tensor allocations'] = allocations / (8 * batch_size)
+
+        tracemalloc.start()
+        for batch in create_batches(frames[:8 * batch_size], batch_size):
+            convert(batch)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report[f'{name} other MB'] = peak / 2 ** 20
+
+    report['max difference'] = (pil(frames[:1]) - frame_tensor(frames[0])).abs().max().item()
+
+    return report
+
+
+def keypoint_postprocessing(clip_path, stride=25, max_frames=None, repeats=10):
+    """
+    Compares the time per frame to turn the heatmaps of the calibration models into keypoints
+    with the array based functions of utils/heatmap.py and the loops they replaced.
+
+    The loops are taken from the copy of heatmap.py kept with the evaluation code.
+    Reports the time per frame of each and whether they give the same keypoints.
+    """
+    import importlib.util
+    import torch
+
+    spec = importlib.util.spec_from_file_location(
+        'heatmap_loops', f'{cdir}/../evaluation/player tracking AP/v8eval/tracking/utils/heatmap.py')
+    loops = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(loops)
+
+    engine = CalibrationEngine()
+
+    # the heatmaps are computed once, only the post-processing is timed
+    heatmaps = []
+    for frame in sv.get_video_frames_generator(clip_path, stride=stride, end=max_frames):
+        x = frame_tensor(frame).to(engine.device)
+        with torch.no_grad():
+            heatmaps.append((engine.model(x)[:, :-1], engine.model_l(x)[:, :-1]))
+    _, _, h, w = x.size()
+
+    def postprocess(module, kp_heatmap, line_heatmap):
+        kp_dict = module.coords_to_dict(
+            module.get_keypoints_from_heatmap_batch_maxpool(kp_heatmap),
+            threshold=engine.kp_threshold,
+        )
+        lines_dict = module.coords_to_dict(
+            module.get_keypoints_from_heatmap_batch_maxpool_l(line_heatmap),
+            threshold=engine.line_threshold,
+        )
+        return module.complete_keypoints(kp_dict, lines_dict, w=w, h=h, normalize=True)[0]
+
+    report = {}
+    for name, module in [('loops', loops), ('arrays', heatmap)]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            keypoints = [postprocess(module, *pair) for pair in heatmaps]
+        report[f'{name} ms'] = 1000 * (time.perf_counter() - start) / (repeats * len(heatmaps))
+        report[name] = keypoints
+
+    report['same keypoints'] = float(report.pop('loops') == report.pop('arrays'))
+
+    return report
+
+
+def ball_tiles(clip_path, ball_path, max_frames=100, tile_sizes=(320, 640, 960), overlap=0.2):
+    """
+    Compares detecting the ball in the downscaled frame and in tiles of the pitch on the CPU.
+
+    Reports the time per frame, the number of tiles per frame and the fraction of the frames the ball is found in.
+    """
+    ball_model = YOLO(ball_path)
+    frames = list(sv.get_video_frames_generator(clip_path, end=max_frames))
+
+    # first call outside the timing so the model is loaded
+    ball_model(frames[0], device='cpu', verbose=False)
+
+    report = {}
+
+    found = 0
+    start = time.perf_counter()
+    for frame in frames:
+        found += len(ball_model(frame, conf=0.5, device='cpu', verbose=False)[0].boxes) > 0
+    elapsed = time.perf_counter() - start
+    report['full'] = (1000 * elapsed / len(frames), 1., found / len(frames))
+
+    for tile in tile_sizes:
+        found, tiles = 0, 0
+        start = time.perf_counter()
+        for frame in frames:
+            found += len(tiled_detections(frame, ball_model, tile=tile, overlap=overlap)) > 0
+        elapsed = time.perf_counter() - start
+
+        for frame in frames:
+            tiles += len(pitch_tiles(frame, tile, overlap)[0])
+
+        report[f'tiles {tile}'] = (1000 * elapsed / len(frames), tiles / len(frames), found / len(frames))
+
+    return report
+
+
+def pitch_filter(clip_path, players_path, ball_path, max_frames=100, margin=3.):
+    """
+    Compares detecting the players and the ball in the whole frame and in the box of the frame holding the pitch.
+
+    The region of each frame is found with the calibration of the previous frame, like in the tracking.
+    Reports the time per frame of the models, the fraction of the pixels they run on, and the
+    number of player boxes per frame found in the whole frame, in the crop and left on the pitch.
+    """
+    players_model = YOLO(players_path)
+    ball_model = YOLO(ball_path)
+    engine = CalibrationEngine()
+    frames = list(sv.get_video_frames_generator(clip_path, end=max_frames))
+
+    # first call outside the timing so the models are loaded
+    detect_frames([frames[0]], players_model, ball_model)
+
+    pitch = PitchFilter(margin=margin)
+    full_time, crop_time = 0., 0.
+    full_boxes, crop_boxes, kept_boxes = 0, 0, 0
+    for frame in frames:
+        start = time.perf_counter()
+        players_detections, _ = detect_frames([frame], players_model, ball_model)[0]
+        full_time += time.perf_counter() - start
+        full_boxes += len(players_detections)
+
+        start = time.perf_counter()
+        crop, offset = pitch.crop(frame, pitch.region)
+        players_detections, _ = detect_frames([crop], players_model, ball_model, offsets=[offset])[0]
+        crop_time += time.perf_counter() - start
+        crop_boxes += len(players_detections)
+
+        P = engine.calibrate(frame)
+        kept_boxes += len(pitch.filter(P, players_detections, frame.shape[:2]))
+        pitch.update(P, frame.shape[:2])
+
+    return {
+        'full ms/frame': 1000 * full_time / len(frames),
+        'crop ms/frame': 1000 * crop_time / len(frames),
+        'pixels': pitch.pixels / pitch.frame_pixels,
+        'full boxes/frame': full_boxes / len(frames),
+        'crop boxes/frame': crop_boxes / len(frames),
+        'pitch boxes/frame': kept_boxes / len(frames),
+    }
+
+
+def combined_detector(dataset_path, players_path, ball_path, combined_path, max_images=200, players_conf=0.3, ball_conf=0.5):
+    """
+    Compares the players and ball models with a combined model on the validation images of the dataset.
+
+    Reports the AP at IoU 0.5 of each class and the frames per second of both setups.
+    The detections are kept with the same confidence thresholds as the tracking.
+    """
+    from supervision.metrics import MeanAveragePrecision
+
+    dataset = sv.DetectionDataset.from_yolo(
+        images_directory_path=f'{dataset_path}/images/val',
+        annotations_directory_path=f'{dataset_path}/labels/val',
+        data_yaml_path=f'{cdir}/../training/config/config.yaml',
+    )
+    images = [(dataset.image_paths[i], dataset[i][2]) for i in range(min(max_images, len(dataset)))]
+
+    setups = {
+        'two models': (YOLO(players_path), YOLO(ball_path), False),
+        'combined': (YOLO(combined_path), None, True),
+    }
+
+    report = {}
+    for name, (players_model, ball_model, combined) in setups.items():
+        # first call outside the timing so the models are loaded
+        image = cv2.imread(images[0][0])
+        detect_frames([image], players_model, ball_model, players_conf, ball_conf, combined=combined)
+
+        metric = MeanAveragePrecision()
+        elapsed = 0.
+        for image_path, targets in images:
+            image = cv2.imread(image_path)
+
+            start = time.perf_counter()
+            players_detections, ball_detections = detect_frames(
+                [image], players_model, ball_model, players_conf, ball_conf, combined=combined)[0]
+            elapsed += time.perf_counter() - start
+
+            # the players model labels the ball too, the ball model is used for it instead
+            players_detections = players_detections[players_detections.class_id != BALL_ID]
+            metric.update(sv.Detections.merge([ball_detections, players_detections]), targets)
+
+        result = metric.compute()
+        ap = dict(zip(result.matched_classes, result.ap_per_class[:, 0]))
+
+        report[name] = (
+            [ap.get(class_id, 0.) for class_id in range(len(dataset.classes))],
+            len(images) / elapsed,
+        )
+
+    return dataset.classes, report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tracking benchmarks')
+
+    parser.add_argument(
+        '--clip_path',
+        type=str,
+        default=f'{cdir}/../results/trimmed/trimmed.mp4',
+        help='Path to the video clip',
+    )
+    parser.add_argument(
+        '--players_path',
+        type=str,
+        default=f'{cdir}/../models/players.pt',
+        help='Path to the players model'
+    )
+    parser.add_argument(
+        '--ball_path',
+        type=str,
+        default=f'{cdir}/../models/ball.pt',
+        help='Path to the ball model',
+    )
+    parser.add_argument(
+        '--combined_path',
+        type=str,
+        default=f'{cdir}/../models/combined.pt',
+        help='Path to the combined model detecting the ball and the players',
+    )
+    parser.add_argument(
+        '--dataset_path',
+        type=str,
+        default=f'{cdir}/../datasets',
+        help='Path to the dataset made by training/data.py',
+    )
+    parser.add_argument(
+        '--max_frames',
+        type=int,
+        default=None,
+        help='Number of frames of the clip to use'
+    )
+    parser.add_argument(
+        '--benchmark',
+        type=str,
+        default='batch',
+        help='Benchmark to run'
+    )
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'batch':
+        report = detection_throughput(
+            args.clip_path,
+            args.players_path,
+            args.ball_path,
+            max_frames=args.max_frames,
+        )
+        for batch_size, fps in report.items():
+            print(f'batch size {batch_size:>3}: {fps:.2f} frames/s')
+
+    elif args.benchmark == 'calib':
+        report = calibration_modes(args.clip_path, max_frames=args.max_frames)
+        for name, value in report.items():
+            print(f'{name}: {value:.2f}')
+
+    elif args.benchmark == 'temporal':
+        report = temporal_calibration(
+            args.clip_path, max_frames=args.max_frames or 250)
+        for name, value in report.items():
+            print(f'{name}: {value:.3f}')
+
+    elif args.benchmark == 'backend':
+        report = inference_backends(
+            args.clip_path,
+            args.players_path,
+            args.ball_path,
+            max_frames=args.max_frames or 50,
+        )
+        for name, fps in report.items():
+            print(f'{name}: {fps:.2f} frames/s')
+
+    elif args.benchmark == 'quantized':
+        report = quantized_calibration(args.clip_path, max_frames=args.max_frames)
+        for name, value in report.items():
+            print(f'{name}: {value:.2f}')
+
+    elif args.benchmark == 'stride':
+        report = detection_stride(
+            args.clip_path,
+            args.players_path,
+            args.ball_path,
+            max_frames=args.max_frames or 250,
+        )
+        print('stride  frames/s  position error m')
+        for stride, (fps, error) in report.items():
+            print(f'{stride:>6}  {fps:>8.2f}  {error:>16.2f}')
+
+    elif args.benchmark == 'ball':
+        report = ball_search(
+            args.clip_path, args.ball_path, max_frames=args.max_frames or 250)
+        for name, value in report.items():
+            print(f'{name}: {value:.2f}')
+
+    elif args.benchmark == 'combined':
+        classes, report = combined_detector(
+            args.dataset_path,
+            args.players_path,
+            args.ball_path,
+            args.combined_path,
+            max_images=args.max_frames or 200,
+        )
+        print(f'{"setup":<10}  ' + '  '.join(f'{c:>10}' for c in classes) + '  frames/s')
+        for name, (ap, fps) in report.items():
+            print(f'{name:<10}  ' + '  '.join(f'{a:>10.3f}' for a in ap) + f'  {fps:>8.2f}')
+
+    elif args.benchmark == 'calib_batch':
+        report = calibration_batches(args.clip_path, max_frames=args.max_frames or 100)
+        print('batch  frames/s  models ms  solver ms')
+        for batch_size, (fps, model_ms, fit_ms) in report.items():
+            print(f'{batch_size:>5}  {fps:>8.2f}  {model_ms:>9.1f}  {fit_ms:>9.1f}')
+
+    elif args.benchmark == 'preprocess':
+        report = calibration_preprocessing(args.clip_path, max_frames=args.max_frames or 100)
+        for name, value in report.items():
+            print(f'{name}: {value:.3f}')
+
+    elif args.benchmark == 'keypoints':
+        report = keypoint_postprocessing(args.clip_path, max_frames=args.max_frames)
+        for name, value in report.items():
+            print(f'{name}: {value:.3f}')
+
+    elif args.benchmark == 'tiles':
+        report = ball_tiles(
+            args.clip_path, args.ball_path, max_frames=args.max_frames or 100)
+        print('search     ms/frame  tiles/frame  found')
+        for name, (ms, tiles, found) in report.items():
+            print(f'{name:<9}  {ms:>8.1f}  {tiles:>11.1f}  {found:>5.2f}')
+
+    elif args.benchmark == 'pitch':
+        report = pitch_filter(
+            args.clip_path,
+            args.players_path,
+            args.ball_path,
+            max_frames=args.max_frames or 100,
+        )
+        for name, value in report.items():
+            print(f'{name}: {value:.2f}')
+
+    elif args.benchmark == 'sampling':
+        report = frame_sampling(args.clip_path, max_samples=args.max_frames)
+        for name, value in report.items():
+            print(f'{name}: {value:.3f}')
+
+    elif args.benchmark == 'team':
+        report = team_backends(
+            args.clip_path, args.players_path, max_frames=args.max_frames)
+        for name, value in report.items():
+            print(f'{name}: {value:.3f}')
@@ -1,17 +1,26 @@
 import os
 import sys
-import pickle
+import cv2
+import time
 import warnings
 import numpy as np
 import subprocess as sp
 import supervision as sv
 
+from dataclasses import dataclass, fields
+from typing import Optional
+
 from tqdm import tqdm
-from ultralytics import YOLO
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from utils.team import TeamClassifier
-from utils.homography import inf_main
+from utils.team import TeamClassifier, TeamCache, create_batches
+from utils.homography import CalibrationEngine, PitchFilter, project as project_points
+from utils.motion import MotionGatedCalibration, BoxPropagator
+from utils.backend import default_device, load_detector, set_threads
+from utils.ball_search import BallSearch
+from utils.scene import SceneClassifier
+from pipeline import Pipeline
+from store import open_writer, save_checkpoint, load_checkpoint, checkpoint_path
 
 warnings.filterwarnings('ignore')
 
@@ -19,7 +28,7 @@ BALL_ID = 0
 PLAYER_ID = 1
 GOALKEEPER_ID = 2
 REFEREE_ID = 3
-DEVICE = 'cuda'
+DEVICE = default_device()
 
 
 def make_video(clip_path, out_path):
@@ -41,14 +50,55 @@ def make_video(clip_path, out_path):
     sp.run(command)
 
 
-def extract_crops(model, source_video_path, stride, player_id, confidence=0.3):
+def sample_frames(source_video_path, stride, start=0, end=None, max_samples=None, max_grab=50):
+    """
+    Yields a frame every stride frames of the video between start and end.
+
+    If max_samples is set and there are more samples, max_samples frames spread evenly
+    over the video are used instead. Unlike reading the video with a stride, the frames
+    in between are never decoded to images: short gaps are skipped with grab and gaps
+    longer than max_grab frames are skipped by seeking, so the time depends on the
+    number of samples rather than the length of the video.
+    """
+    video = cv2.VideoCapture(source_video_path)
+    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    end = total_frames if end is None else min(end, total_frames)
+
+    targets = np.arange(start, end, stride)
+    if max_samples is not None and len(targets) > max_samples:
+        targets = np.linspace(start, end - 1, max_samples).round().astype(int)
+
+    position = 0
+    try:
+        for target in targets:
+            if target - position > max_grab or target < position:
+                video.set(cv2.CAP_PROP_POS_FRAMES, int(target))
+                position = target
+
+            while position < target:
+                if not video.grab():
+                    return
+                position += 1
+
+            success, frame = video.read()
+            if not success:
+                return
+            position += 1
+
+            yield frame
+    finally:
+        video.release()
+
+
+def extract_crops(model, source_video_path, stride, player_id, confidence=0.3, start=0, end=None, max_samples=None):
     """
     Returns the crops of the frame where the player is detected in the video.
 
     Uses the bounding box of the detection to crop the image.
+    Only the frames between start and end are used, and at most max_samples of them if it is set.
     """
-    frame_generator = sv.get_video_frames_generator(
-        source_video_path, stride=stride
+    frame_generator = sample_frames(
+        source_video_path, stride, start=start, end=end, max_samples=max_samples
     )
 
     crops = []
@@ -64,9 +114,12 @@ def extract_crops(model, source_video_path, stride, player_id, confidence=0.3):
     return crops
 
 
-def classifier(model, clip_path, video_info, confidence=0.3):
+def classifier(model, clip_path, video_info, confidence=0.3, start=0, end=None, backend='siglip', max_samples=None):
     """
-    Separates the players in the video into two teams using the SigLIP model
+    Separates the players in the video into two teams using the SigLIP model,
+    or the colors of their shirts if backend is 'color'
+
+    A frame from every second of the video is used, or max_samples frames spread over the video.
     """
     stride = video_info.fps
 
@@ -75,11 +128,15 @@ def classifier(model, clip_path, video_info, confidence=0.3):
         clip_path,
         stride,
         PLAYER_ID,
-        confidence=confidence
+        confidence=confidence,
+        start=start,
+        end=end,
+        max_samples=max_samples,
     )
 
     # Initialize the TeamClassifier model and fit it to the crops
-    team_classifier = TeamClassifier(device=DEVICE, verbose=False)
+    team_classifier = TeamClassifier(
+        device=DEVICE, verbose=False, backend=backend)
     team_classifier.fit(crops)
 
     return team_classifier
@@ -107,19 +164,42 @@ def goalkeepers_team(players, goalkeepers):
     return np.array(goalkeepers_team_id)
 
 
-def team_detection(frame, detections, team_classifier):
+def players_crops(frame, detections):
+    """
+    Returns the crops of the players in the frame, in the order of the detections.
+    """
+    players_detections = detections[detections.class_id == PLAYER_ID]
+
+    return [sv.crop_image(frame, xyxy) for xyxy in players_detections.xyxy]
+
+
+def team_detection(frame, detections, team_classifier, team_cache=None, crops=None):
     """
     Assigns a team to the detected players
+
+    If a team cache is given, only the players whose team is not known yet are classified.
+    If the crops of the players are given, the frame is not used.
     """
     goalkeeper_detections = detections[detections.class_id == GOALKEEPER_ID]
     players_detections = detections[detections.class_id == PLAYER_ID]
     referees_detections = detections[detections.class_id == REFEREE_ID]
 
-    players_crops = [sv.crop_image(frame, xyxy)
-                     for xyxy in players_detections.xyxy]
-    players_detections.class_id = team_classifier.predict(
-        players_crops
-    )
+    if crops is None:
+        crops = players_crops(frame, detections)
+
+    if team_cache is None:
+        players_detections.class_id = team_classifier.predict(crops)
+    else:
+        tracker_ids = players_detections.tracker_id
+        teams, missing = team_cache.lookup(tracker_ids)
+
+        crops = [crop for crop, m in zip(crops, missing) if m]
+        if crops:
+            teams[missing] = team_cache.update(
+                tracker_ids[missing],
+                team_classifier.predict(crops),
+            )
+        players_detections.class_id = teams
     goalkeeper_detections.class_id = goalkeepers_team(
         players_detections,
         goalkeeper_detections,
@@ -135,92 +215,650 @@ def team_detection(frame, detections, team_classifier):
     return updated
 
 
-def get_coords(frame, detections, project=False):
+def get_coords(frame, detections, engine=None):
     """
     Returns the tracking ids, class ids and coordinates of the detections.
 
-    If project is True, the coordinates are projected to the 2D plane.
+    If a calibration engine is given, the coordinates are projected to the 2D plane.
     """
     coords = detections.xyxy
     tracking_ids = detections.tracker_id
     class_ids = detections.class_id
 
-    if project:
-        coords, edges = inf_main(frame, coords)
+    if engine is not None:
+        engine.calibrate(frame)
+        coords, edges = engine.project(coords)
         return (list(zip(tracking_ids, class_ids, coords)), edges)
 
     return list(zip(tracking_ids, class_ids, coords))
 
 
-def detections(clip_path, players_path, ball_path, pkl_path, players_conf=0.3, ball_conf=0.5, project=True, verbose=False):
+def projected_coords(detections, P, size):
     """
-    Detects the players and the ball in the video and saves the detections in a pickle file.
-
-    Detection confidence for players and ball can be set using players_conf and ball_conf respectively.
-    If return_class is True, the detection class is saved. This is used to make the video.
-    If project is True, the detections are projected to the 2D plane. This is used to make the minimap.
+    Returns the tracking ids, class ids and projected coordinates of the detections
+    using a projection matrix found earlier, or empty points if it is None.
     """
-    players_model = YOLO(players_path)
-    ball_model = YOLO(ball_path)
+    if P is None:
+        coords, edges = [], []
+    else:
+        coords, edges = project_points(P, detections.xyxy, *size)
 
-    # tracking ids are maintained using ByteTrack
-    tracker = sv.ByteTrack()
-    tracker.reset()
+    return (list(zip(detections.tracker_id, detections.class_id, coords)), edges)
 
-    video_info = sv.VideoInfo.from_video_path(clip_path)
-    # initialize the team classifier model using a frame from every second of the video
-    team_classifier = classifier(
-        players_model, clip_path, video_info, confidence=players_conf)
 
-    frame_generator = sv.get_video_frames_generator(clip_path)
+def split_classes(detections, players_conf=0.3, ball_conf=0.5):
+    """
+    Splits the detections of a combined model into the players and the ball,
+    each kept above its own confidence threshold.
+    """
+    ball = detections.class_id == BALL_ID
 
-    detect = []
-    coordinates = []
+    players_detections = detections[~ball & (detections.confidence >= players_conf)]
+    ball_detections = detections[ball & (detections.confidence >= ball_conf)]
 
-    for frame in tqdm(frame_generator, total=video_info.total_frames) if verbose else frame_generator:
-        # detect players in the frame
-        player_result = players_model(
-            frame, conf=players_conf, verbose=False)[0]
+    return players_detections, ball_detections
 
-        players_detections = sv.Detections.from_ultralytics(player_result)
-        players_detections = players_detections.with_nms(
-            threshold=0.5,
-            class_agnostic=True,
-        )
 
-        # update the tracker with the new detections
-        players_detections = tracker.update_with_detections(players_detections)
-        players_detections = team_detection(
-            frame, players_detections, team_classifier)
-        players_detections.class_id = players_detections.class_id.astype(int)
+def shift_boxes(detections, offset):
+    """
+    Moves the boxes detected in a crop of the frame back to the frame.
+    """
+    x, y = offset
+    if x or y:
+        detections.xyxy = detections.xyxy + np.array([x, y, x, y], dtype=detections.xyxy.dtype)
 
-        # detect the ball in the frame
-        ball_result = ball_model(frame, conf=ball_conf, verbose=False)[0]
-        ball_detections = sv.Detections.from_ultralytics(ball_result)
+    return detections
 
-        # accounting for frames where no players or balls are detected
-        if len(players_detections) == 0:
-            players_detections.tracker_id = np.array([])
 
-        if len(ball_detections) == 0:
-            ball_detections.tracker_id = np.array([])
+def detect_frames(frames, players_model, ball_model, players_conf=0.3, ball_conf=0.5, combined=False, offsets=None):
+    """
+    Runs the players and ball models on a batch of frames.
+
+    Returns the players and ball detections of each frame in the same order as the frames.
+    If ball_model is None, the ball detections are None and are left to the caller.
+    If combined is True, players_model detects the ball too and is the only model run,
+    ball_model is not used and the players and the ball are split from its detections
+    with their own confidence.
+    If the frames are crops, offsets holds the top left corner of each crop in its frame
+    and the boxes are moved back to the frames.
+    """
+    if combined:
+        results = players_model(frames, conf=min(players_conf, ball_conf), verbose=False)
+        detections = [
+            split_classes(sv.Detections.from_ultralytics(result), players_conf, ball_conf)
+            for result in results
+        ]
+    else:
+        player_results = players_model(frames, conf=players_conf, verbose=False)
+        if ball_model is None:
+            ball_results = [None] * len(frames)
         else:
-            # if multiple balls are detected, choose the one with the highest confidence
-            max_conf = ball_detections.confidence.max()
-            ball_detections = ball_detections[ball_detections.confidence == max_conf]
-            ball_detections.tracker_id = np.array([-1]*len(ball_detections))
-
-        try:
-            # merge the detections of the players and the ball
-            detections = sv.Detections.merge(
-                [ball_detections, players_detections])
-        except:
-            detections = sv.Detections.empty()
-            detections.tracker_id = np.array([])
-
-        detect.append(detections)
-        coordinates.append(get_coords(frame, detections, project=project))
-
-    # save the detections in a pickle file
-    with open(pkl_path, 'wb') as f:
-        pickle.dump((detect, coordinates), f)
+            ball_results = ball_model(frames, conf=ball_conf, verbose=False)
+
+        detections = [
+            (sv.Detections.from_ultralytics(player_result),
+             None if ball_result is None else sv.Detections.from_ultralytics(ball_result))
+            for player_result, ball_result in zip(player_results, ball_results)
+        ]
+
+    if offsets is None:
+        return detections
+
+    return [
+        (shift_boxes(players_detections, offset),
+         None if ball_detections is None else shift_boxes(ball_detections, offset))
+        for (players_detections, ball_detections), offset in zip(detections, offsets)
+    ]
+
+
+def track_players(players_detections, tracker):
+    """
+    Removes the overlapping boxes and updates the tracker with the players of a single frame.
+    """
+    players_detections = players_detections.with_nms(
+        threshold=0.5,
+        class_agnostic=True,
+    )
+
+    # update the tracker with the new detections
+    return tracker.update_with_detections(players_detections)
+
+
+def reset_tracks(tracker):
+    """
+    Drops the tracks of the tracker after a cut so they are not matched to the players of the new shot.
+
+    Unlike ByteTrack.reset, the id counter is kept, so the new tracks do not reuse the ids of earlier ones.
+    """
+    tracker.tracked_tracks = []
+    tracker.lost_tracks = []
+    tracker.removed_tracks = []
+
+
+def empty_frame(project):
+    """
+    Returns the detections and coordinates of a frame that is not processed.
+    """
+    detections = sv.Detections.empty()
+    detections.tracker_id = np.array([], dtype=int)
+
+    return detections, (([], []) if project else [])
+
+
+def track_frame(frame, players_detections, ball_detections, tracker, team_classifier, team_cache=None):
+    """
+    Tracks the players, assigns their teams and picks the ball for a single frame.
+
+    Returns the merged detections of the ball and the players.
+    """
+    players_detections = track_players(players_detections, tracker)
+    players_detections = team_detection(
+        frame, players_detections, team_classifier, team_cache)
+
+    return merge_ball(players_detections, ball_detections)
+
+
+def merge_ball(players_detections, ball_detections):
+    """
+    Picks the ball and merges it with the players whose teams are assigned.
+    """
+    players_detections.class_id = players_detections.class_id.astype(int)
+
+    # accounting for frames where no players or balls are detected
+    if len(players_detections) == 0:
+        players_detections.tracker_id = np.array([])
+
+    if len(ball_detections) == 0:
+        ball_detections.tracker_id = np.array([])
+    else:
+        # if multiple balls are detected, choose the one with the highest confidence
+        max_conf = ball_detections.confidence.max()
+        ball_detections = ball_detections[ball_detections.confidence == max_conf]
+        ball_detections.tracker_id = np.array([-1]*len(ball_detections))
+
+    try:
+        # merge the detections of the players and the ball
+        detections = sv.Detections.merge(
+            [ball_detections, players_detections])
+    except:
+        detections = sv.Detections.empty()
+        detections.tracker_id = np.array([])
+
+    return detections
+
+
+@dataclass
+class DetectionConfig:
+    """
+    Options of the detections, shared by main.py, shard.py and the benchmarks.
+
+    Detection: players_conf and ball_conf are the confidence of the players and the ball. batch_size
+    frames are sent to the models at once, the calibration models included unless motion_gated is set.
+    The frames are still tracked and the cameras solved one by one in order, so the tracking ids do not
+    depend on the batch size. If threaded is True, decoding, inference and tracking run in a pipeline of
+    threads, with workers inference threads and queues holding queue_size batches between the stages.
+    The models are run on one frame every detect_stride frames. On the frames in between, the boxes
+    of the last detected frame are moved with optical flow and tracked as usual, and their detections
+    are marked in the 'interpolated' data field.
+
+    Calibration: if project is True, the detections are projected to the 2D plane, this is used to make
+    the minimap. calib_mode is 'full' to calibrate with the voting between calibration modes, 'fast'
+    to use a single ground plane homography when its reprojection error is low enough, or 'temporal'
+    to start the solver from the camera of the previous frame. If motion_gated is True, the camera is
+    fully calibrated only on keyframes (scene cuts, large camera motion or every key_interval frames)
+    and followed with optical flow in between, until the drift reaches max_drift pixels.
+
+    Teams: if team_cache is True, the team of each tracking id is remembered once the classifier is
+    confident about it instead of classifying every player on every frame. team_backend is 'siglip'
+    to tell the teams apart with SigLIP embeddings, or 'color' to use the colors of the shirts, which
+    is much faster and does not need to load a model. If single_pass is True, the team classifier is
+    fitted on the players of the first warmup seconds of the main loop instead of a separate pass over
+    the video. These frames are tracked and calibrated as they come, and their teams are assigned once
+    the classifier is fitted. Otherwise, the classifier is fitted on a frame from every second of the
+    video, or on max_samples frames spread over the video if it is set.
+
+    Output: a store output is written in chunks of chunk_size frames, and checkpoints are saved every
+    chunk_size frames.
+
+    Backends: backend is 'torch' to run the detection and calibration models with PyTorch, or 'onnx' or
+    'openvino' to run graphs exported once next to the weights on the CPU, falling back to PyTorch
+    if the export fails. threads sets the number of CPU threads of the PyTorch models and of the exported
+    calibration models, the detection models exported by ultralytics use the default of their runtime.
+    If quantized is True, the exported calibration models use the INT8 graphs built by utils/quantize.py,
+    which needs the onnx or openvino backend.
+
+    Ball: if ball_roi is True, the ball is searched in a window of ball_window pixels around its position
+    predicted from the previous frames, growing on every miss, and in the whole frame after ball_misses
+    misses in a row. The ball is then detected frame by frame in order instead of in the batches.
+    If ball_tiles is True, the whole frame searches run the ball model on the tiles of tile_size pixels,
+    overlapping by tile_overlap, that show the pitch, in one batch. Without ball_roi, every frame is
+    searched in tiles.
+
+    Scenes: if scenes is True, every frame is tagged as showing the pitch if at least min_green of it
+    is green, and as a cut if it starts a new shot. Frames that do not show the pitch (close-ups, replays,
+    crowd shots, graphics) are written without detections or calibration, and the tracks are dropped on
+    cuts. The tags are saved with the output and read back with store.load_scenes. If pitch_filter is
+    True and project is True, the detection models only run on the box of the frame holding the pitch,
+    extended by pitch_margin meters, found with the calibration of the frame before the batch, and the
+    players standing off the pitch are dropped before tracking. It cannot be used with threaded.
+    """
+    # detection
+    players_conf: float = 0.3
+    ball_conf: float = 0.5
+    batch_size: int = 1
+    threaded: bool = False
+    workers: int = 1
+    queue_size: int = 4
+    detect_stride: int = 1
+
+    # calibration
+    project: bool = True
+    calib_mode: str = 'full'
+    motion_gated: bool = False
+    key_interval: int = 25
+    max_drift: float = 5.
+
+    # teams
+    team_cache: bool = False
+    team_backend: str = 'siglip'
+    single_pass: bool = False
+    warmup: float = 10
+    max_samples: Optional[int] = None
+
+    # output
+    chunk_size: int = 1000
+
+    # backends
+    backend: str = 'torch'
+    threads: Optional[int] = None
+    quantized: bool = False
+
+    # ball
+    ball_roi: bool = False
+    ball_window: int = 640
+    ball_misses: int = 5
+    ball_tiles: bool = False
+    tile_size: int = 640
+    tile_overlap: float = 0.2
+
+    # scenes
+    scenes: bool = False
+    min_green: float = 0.3
+    pitch_filter: bool = False
+    pitch_margin: float = 3.
+
+    verbose: bool = False
+
+    def __post_init__(self):
+        # the INT8 graphs only run on the exported backends, PyTorch would silently use the FP32 models
+        if self.quantized and self.backend not in ['onnx', 'openvino']:
+            raise ValueError('quantized needs the onnx or openvino backend')
+        # the inference threads run ahead of the calibration, so the crops would depend on the timing of the threads
+        if self.pitch_filter and self.threaded:
+            raise ValueError('pitch_filter cannot be used with threaded')
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Returns the options set by the command line arguments with the same names.
+        """
+        return cls(**{f.name: getattr(args, f.name) for f in fields(cls) if hasattr(args, f.name)})
+
+
+def detections(clip_path, players_path, ball_path, pkl_path, config=None, start=0, end=None, checkpoint=False, resume=False):
+    """
+    Detects the players and the ball in the video and saves the detections.
+
+    If pkl_path ends with .pkl, the detections are saved in a pickle file at the end of the run.
+    Otherwise they are written to a store at pkl_path in chunks of frames as they come.
+
+    If ball_path is None, the model at players_path is a combined model detecting the ball along with
+    the players, goalkeepers and referees, so a single model runs on every frame. Its detections are split
+    by class with the confidence of the players and the ball.
+    config holds the options of the run, see DetectionConfig, the defaults are used if it is None.
+    Only the frames between start and end are processed, this is used to run shards of the video.
+    If checkpoint is True, the state of the run (the output so far, the tracker, the team classifier
+    and the calibration) is saved next to the output every chunk_size frames. If resume is True,
+    the run restarts from the last checkpoint instead of the start, and the output is the same as
+    if it was never stopped. The checkpoint is removed once the run is complete.
+    """
+    run_start = time.perf_counter()
+
+    if config is None:
+        config = DetectionConfig()
+
+    set_threads(config.threads)
+    players_model = load_detector(players_path, config.backend)
+    # a combined model detects the ball too, so there is no separate ball model
+    combined = ball_path is None
+    ball_model = None if combined else load_detector(ball_path, config.backend)
+
+    video_info = sv.VideoInfo.from_video_path(clip_path)
+    end = video_info.total_frames if end is None else min(end, video_info.total_frames)
+
+    state = load_checkpoint(pkl_path) if resume else None
+    checkpoint = checkpoint or resume
+
+    if state is not None:
+        # continue from the frame after the last checkpoint with the state it saved
+        tracker = state['tracker']
+        team_classifier = state['team_classifier']
+        cache = state['cache']
+        engine = state['engine']
+        writer = state['writer']
+        start = state['frame']
+    else:
+        # tracking ids are maintained using ByteTrack
+        tracker = sv.ByteTrack()
+        tracker.reset()
+
+        # initialize the team classifier model using a frame from every second of the video
+        team_classifier = None
+        if not config.single_pass:
+            team_classifier = classifier(
+                players_model,
+                clip_path,
+                video_info,
+                confidence=config.players_conf,
+                start=start,
+                end=end,
+                backend=config.team_backend,
+                max_samples=config.max_samples,
+            )
+
+        cache = TeamCache() if config.team_cache else None
+
+        # the calibration models are loaded once and reused for every frame
+        engine = CalibrationEngine(
+            mode=config.calib_mode,
+            device=DEVICE,
+            backend=config.backend,
+            threads=config.threads,
+            quantized=config.quantized,
+        ) if config.project else None
+        if engine is not None and config.motion_gated:
+            engine = MotionGatedCalibration(
+                engine, key_interval=config.key_interval, max_drift=config.max_drift)
+
+        writer = open_writer(pkl_path, chunk_size=config.chunk_size)
+
+    frame_generator = sv.get_video_frames_generator(
+        clip_path, start=start, end=end)
+    if config.verbose:
+        frame_generator = tqdm(frame_generator, total=end - start)
+
+    propagator = state.get('propagator') if state is not None else None
+    if propagator is None and config.detect_stride > 1:
+        propagator = BoxPropagator()
+
+    # every frame is paired with whether the models run on it, the first frame is
+    # detected unless there are detections to follow from the checkpoint
+    follow = propagator is not None and propagator.last is not None
+
+    ball_search = state.get('ball_search') if state is not None else None
+    search_model = ball_model
+    if combined and (ball_search is not None or config.ball_roi or config.ball_tiles):
+        # the search runs in the tracking thread, so it gets its own copy of the combined model when threaded
+        search_model = load_detector(players_path, config.backend) if config.threaded else players_model
+    if ball_search is None and (config.ball_roi or config.ball_tiles):
+        ball_search = BallSearch(
+            search_model,
+            confidence=config.ball_conf,
+            window=config.ball_window,
+            # without the window search the whole frame is searched every frame
+            max_misses=config.ball_misses if config.ball_roi else 0,
+            tiles=config.ball_tiles,
+            tile_size=config.tile_size,
+            tile_overlap=config.tile_overlap,
+            classes=[BALL_ID] if combined else None,
+        )
+    if ball_search is not None:
+        # the search follows the ball from frame to frame, so it runs in order with its own model
+        ball_search.model = search_model
+
+    pitch = PitchFilter(margin=config.pitch_margin) if config.pitch_filter and config.project else None
+    if pitch is not None and state is not None:
+        # the frames after the checkpoint are cropped to the pitch of the last frame before it
+        pitch.region = state.get('pitch_region')
+
+    scene = SceneClassifier(min_green=config.min_green) if config.scenes else None
+    if scene is not None and state is not None:
+        # the first frame after the checkpoint is compared to the last frame before it
+        scene.prev_hist = state.get('scene_hist')
+
+    def tag(frames):
+        # every frame is paired with whether the models run on it and its scene tags, the first frame
+        # of a shot is detected unless there are detections to follow from the checkpoint
+        fresh = not follow
+        for i, frame in enumerate(frames):
+            live, cut = scene(frame) if scene is not None else (True, False)
+            fresh = fresh or cut or not live
+            detected = live and ((start + i) % config.detect_stride == 0 or fresh)
+            fresh = fresh and not detected
+
+            yield frame, detected, live, cut
+
+    frame_generator = tag(frame_generator)
+
+    # frames waiting for the team classifier in a single pass
+    buffer = []
+    warmup_frames = max(1, int(config.warmup * video_info.fps))
+    first_output = None
+
+    # the next frame to output and the frame the last checkpoint was saved at
+    position = start
+    saved_at = start
+
+    def output(detections, coords, interpolated=False, live=True, cut=False):
+        nonlocal first_output, position
+        if first_output is None:
+            first_output = time.perf_counter() - run_start
+
+        detections.data['interpolated'] = np.full(len(detections), interpolated)
+        writer.append(detections, coords, live=live, cut=cut)
+        position += 1
+
+    def save(last_frame):
+        nonlocal saved_at
+        save_checkpoint(pkl_path, dict(
+            frame=position,
+            tracker=tracker,
+            team_classifier=team_classifier,
+            cache=cache,
+            engine=engine,
+            writer=writer,
+            propagator=propagator,
+            ball_search=ball_search,
+            # the decoding runs ahead when threaded, so the histogram is taken from the last frame written
+            scene_hist=scene.histogram(last_frame) if scene is not None else None,
+            pitch_region=pitch.region if pitch is not None else None,
+        ))
+        saved_at = position
+
+    def flush():
+        # fit on 5 frames per second of the buffer, close frames mostly repeat the same crops
+        stride = max(1, video_info.fps // 5)
+        crops = [crop for _, _, frame_crops, *_ in buffer[::stride] for crop in frame_crops]
+
+        fitted = TeamClassifier(device=DEVICE, verbose=False, backend=config.team_backend)
+        fitted.fit(crops)
+
+        for players_detections, ball_detections, frame_crops, P, size, interpolated, live, cut in buffer:
+            if not live:
+                output(*empty_frame(engine is not None), live=live, cut=cut)
+                continue
+
+            players_detections = team_detection(
+                None, players_detections, fitted, cache, crops=frame_crops)
+            detections = merge_ball(players_detections, ball_detections)
+
+            if engine is None:
+                coords = get_coords(None, detections)
+            else:
+                coords = projected_coords(detections, P, size)
+            output(detections, coords, interpolated, cut=cut)
+
+        buffer.clear()
+        return fitted
+
+    def infer(models):
+        def worker(items):
+            # detect players and the ball in all the detected frames of the batch at once
+            frames = [frame for frame, detected, *_ in items if detected]
+
+            offsets = None
+            if pitch is not None and frames:
+                # the frames of the batch from a cut on do not show the calibrated pitch
+                region = pitch.region
+                regions = []
+                for _, detected, _, cut in items:
+                    region = None if cut else region
+                    if detected:
+                        regions.append(region)
+                frames, offsets = zip(*[
+                    pitch.crop(frame, region) for frame, region in zip(frames, regions)])
+                frames = list(frames)
+
+            players_model, ball_model = models
+            results = iter(detect_frames(
+                frames,
+                players_model,
+                ball_model if ball_search is None else None,
+                players_conf=config.players_conf,
+                ball_conf=config.ball_conf,
+                combined=combined,
+                offsets=offsets,
+            ) if frames else [])
+
+            return [next(results) if detected else None for _, detected, *_ in items]
+
+        return worker
+
+    def sink(items, results):
+        nonlocal team_classifier
+
+        # the calibration models run once on the whole batch, the motion gate decides frame by frame
+        projections = [None] * len(items)
+        batch_calibrated = isinstance(engine, CalibrationEngine)
+        live_frames = [frame for frame, _, live, _ in items if live]
+        if batch_calibrated and live_frames:
+            calibrated = iter(engine.calibrate_batch(live_frames))
+            projections = [next(calibrated) if live else None for _, _, live, _ in items]
+
+        for (frame, detected, live, cut), result, P in zip(items, results, projections):
+            if cut:
+                # the players of the new shot are not the ones on screen before it
+                reset_tracks(tracker)
+                if propagator is not None:
+                    propagator.last = None
+                if ball_search is not None:
+                    ball_search.reset()
+                if pitch is not None:
+                    pitch.reset()
+
+            if not live:
+                # nothing to detect or calibrate, the frames waiting for the classifier keep their order
+                if team_classifier is None:
+                    buffer.append((None, None, [], None, frame.shape[:2], False, live, cut))
+                else:
+                    output(*empty_frame(engine is not None), live=live, cut=cut)
+                continue
+
+            if ball_search is not None and result is not None:
+                result = (result[0], ball_search(frame))
+
+            # follow the last detections on the frames that are not detected
+            if propagator is not None:
+                result = propagator(frame, result)
+            players_detections, ball_detections = result
+            interpolated = not detected
+
+            if pitch is not None:
+                # the camera of the frame if the batch is calibrated, or of the previous frame
+                frame_P = P if batch_calibrated else engine.P
+                players_detections = pitch.filter(frame_P, players_detections, frame.shape[:2])
+                # the next batch is cropped to the pitch of this camera
+                pitch.update(frame_P, frame.shape[:2])
+
+            if team_classifier is not None:
+                detections = track_frame(
+                    frame,
+                    players_detections,
+                    ball_detections,
+                    tracker,
+                    team_classifier,
+                    team_cache=cache,
+                )
+                if batch_calibrated:
+                    coords = projected_coords(detections, P, frame.shape[:2])
+                else:
+                    coords = get_coords(frame, detections, engine=engine)
+                output(detections, coords, interpolated, cut=cut)
+                continue
+
+            # keep only the crops and the camera of the frame until the classifier is fitted
+            players_detections = track_players(players_detections, tracker)
+            if engine is not None and not batch_calibrated:
+                P = engine.calibrate(frame)
+            buffer.append((
+                players_detections,
+                ball_detections,
+                players_crops(frame, players_detections),
+                P,
+                frame.shape[:2],
+                interpolated,
+                live,
+                cut,
+            ))
+
+            if len(buffer) >= warmup_frames:
+                team_classifier = flush()
+
+        # frames waiting for the team classifier are not saved, so the checkpoint waits for them
+        if checkpoint and not buffer and position - saved_at >= config.chunk_size:
+            save(items[-1][0])
+
+    if config.threaded:
+        # each inference thread gets its own copy of the models
+        models = [(players_model, ball_model)]
+        models += [(load_detector(players_path, config.backend),
+                    None if combined else load_detector(ball_path, config.backend))
+                   for _ in range(config.workers - 1)]
+
+        pipeline = Pipeline(
+            [infer(m) for m in models],
+            batch_size=config.batch_size,
+            frame_queue_size=config.queue_size,
+            result_queue_size=config.queue_size,
+        )
+        pipeline.run(frame_generator, sink)
+
+        if config.verbose:
+            print(pipeline.report())
+    else:
+        worker = infer((players_model, ball_model))
+        for frames in create_batches(frame_generator, config.batch_size):
+            sink(frames, worker(frames))
+
+    # the video ended before the warmup did
+    if buffer:
+        team_classifier = flush()
+
+    if config.verbose:
+        print(f'Startup latency: {first_output or 0.:.2f}s to the first output frame')
+    if config.verbose and engine is not None:
+        print(engine.report())
+    if config.verbose and cache is not None:
+        print(cache.report())
+    if config.verbose and ball_search is not None:
+        print(ball_search.report())
+    if config.verbose and scene is not None:
+        print(scene.report())
+    if config.verbose and pitch is not None:
+        print(pitch.report())
+
+    # write the frames left in the pickle or the store
+    writer.close()
+
+    if checkpoint and os.path.exists(checkpoint_path(pkl_path)):
+        os.remove(checkpoint_path(pkl_path))
@@ -1,10 +1,12 @@
 import os
+import sys
 import cv2
-import pickle
 import numpy as np
 import supervision as sv
 
 cdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(cdir)
+from store import load_detections
 
 color_map = {
     0: (255, 255, 255),
@@ -42,9 +44,8 @@ def draw_markers(clip_path, out_path, pkl_path, ball_id=0):
     """
     Uses the detections to annotate the original video.
     """
-    with open(pkl_path, 'rb') as f:
-        detections, _ = pickle.load(f)
-        
+    detections = load_detections(pkl_path)
+
     video_info = sv.VideoInfo.from_video_path(clip_path)
     video_sink = sv.VideoSink(out_path, video_info)
 
@@ -105,7 +106,8 @@ def draw_minimap(ball_data, players_data, edges_data, out_path, image_path=f'{cd
             color = color_map[class_id]
             cv2.circle(frame, (x, y), 6, color, -1)
 
-        if len(ball_data) > i + 2:
+        # the ball is nan on the frames that do not show the pitch
+        if len(ball_data) > i + 2 and not np.isnan(ball_data[i + 2]).any():
             x, y = ball_data[i + 2]
             x = int(x * dimensions[0])
             y = int(y * dimensions[1])
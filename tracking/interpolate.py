@@ -1,7 +1,11 @@
-import pickle
+import os
+import sys
 import numpy as np
 import pandas as pd
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from store import load_coordinates, load_scenes
+
 
 def interpolate(frames, k, mode):
     """
@@ -29,23 +33,30 @@ def ball_interpolate(pkl_path):
     """
     Interpolates the ball coordinates by linearly
     interpolating the missing values from the frames
+
+    The gaps are only filled within a shot of frames showing the pitch,
+    the frames that do not show it are left empty (nan)
     """
-    with open(pkl_path, 'rb') as f:
-        _, data_list = pickle.load(f)
+    data_list = load_coordinates(pkl_path)
+    scenes = load_scenes(pkl_path)
 
-    ball_data = pd.DataFrame(columns=['frame', 'x', 'y'])
+    ball_data = pd.DataFrame(
+        {'frame': np.arange(len(data_list)), 'x': np.nan, 'y': np.nan})
 
     for i, (f, _) in enumerate(data_list):
         for track, _, (x, y) in f:
             if track == -1 and x > 0 and y > 0 and x < 105 and y < 68:
-                ball_data.loc[i] = {'frame': i, 'x': x, 'y': y}
-            else:
-                # input nan for the frames where the ball is not detected
-                # these frames will be interpolated
-                ball_data.loc[i] = {'frame': i, 'x': np.nan, 'y': np.nan}
+                ball_data.loc[i, ['x', 'y']] = x, y
+            # the frames where the ball is not detected stay nan
+            # these frames will be interpolated
             break
 
-    ball_data = ball_data.interpolate()
+    # a new shot starts on every cut and after every frame that does not show the pitch
+    live, cut = scenes[:, 0], scenes[:, 1]
+    shot = np.cumsum(cut | ~live)
+
+    ball_data[['x', 'y']] = ball_data[live].groupby(shot[live])[['x', 'y']].transform(
+        lambda values: values.interpolate())
     ball_data = list(zip(ball_data['x'], ball_data['y']))
 
     return ball_data
@@ -56,8 +67,7 @@ def players_interpolate(pkl_path):
     Interpolates the players coordinates by taking a 
     weighted average of the frames around it
     """
-    with open(pkl_path, 'rb') as f:
-        _, data_list = pickle.load(f)
+    data_list = load_coordinates(pkl_path)
 
     players_data = []
 
@@ -88,8 +98,7 @@ def edges_interpolate(pkl_path):
     Interpolates the values of the edges of the visible
     cone by taking a weighted average of the frames around it
     """
-    with open(pkl_path, 'rb') as f:
-        _, data_list = pickle.load(f)
+    data_list = load_coordinates(pkl_path)
 
     edges_data = []
 
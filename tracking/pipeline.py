@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import queue
+import threading
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from utils.team import create_batches
+
+# marks the end of the frames for a stage
+DONE = object()
+
+
+class Pipeline:
+    """
+    Runs the tracking stage as a decode -> inference -> sink pipeline.
+
+    A decoder thread fills a bounded queue with batches of frames, one inference
+    thread per worker runs the models on them and the sink receives the results
+    in frame order in the calling thread. Bounded queues give back-pressure, so
+    the decoder never runs more than frame_queue_size batches ahead.
+    """
+
+    def __init__(self, workers, batch_size=1, frame_queue_size=4, result_queue_size=4):
+        """
+        workers is a list of functions taking a batch of frames and returning their results.
+        Each worker runs in its own thread, so it should own its models.
+        """
+        self.workers = workers
+        self.batch_size = batch_size
+        self.frame_queue = queue.Queue(maxsize=frame_queue_size)
+        self.result_queue = queue.Queue(maxsize=result_queue_size)
+
+        self.stop = threading.Event()
+        self.errors = []
+        self.busy = {}
+        self.wall = 0.
+
+    def put(self, q, item):
+        """
+        Puts the item in the queue, waiting while it is full unless the pipeline is stopped.
+        """
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def get(self, q):
+        """
+        Gets an item from the queue, returns DONE if the pipeline is stopped.
+        """
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+        return DONE
+
+    def fail(self, error):
+        self.errors.append(error)
+        self.stop.set()
+
+    def decode(self, frame_generator):
+        """
+        Decodes the frames and sends them to the workers in batches.
+        """
+        busy = 0.
+        batches = create_batches(frame_generator, self.batch_size)
+
+        try:
+            index = 0
+            while True:
+                start = time.perf_counter()
+                frames = next(batches, None)
+                busy += time.perf_counter() - start
+
+                if frames is None or not self.put(self.frame_queue, (index, frames)):
+                    break
+                index += 1
+        except Exception as e:
+            self.fail(e)
+        finally:
+            for _ in self.workers:
+                self.put(self.frame_queue, DONE)
+            self.busy['decode'] = busy
+
+    def infer(self, name, worker):
+        """
+        Runs the worker on the batches of frames until the decoder is done.
+        """
+        busy = 0.
+
+        try:
+            while True:
+                item = self.get(self.frame_queue)
+                if item is DONE:
+                    break
+
+                index, frames = item
+                start = time.perf_counter()
+                results = worker(frames)
+                busy += time.perf_counter() - start
+
+                if not self.put(self.result_queue, (index, frames, results)):
+                    break
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.put(self.result_queue, DONE)
+            self.busy[name] = busy
+
+    def run(self, frame_generator, sink):
+        """
+        Runs the pipeline on the frames and calls sink(frames, results) for each batch in order.
+        """
+        start = time.perf_counter()
+        busy = 0.
+
+        names = [f'inference {i}' for i in range(len(self.workers))]
+        self.busy = dict.fromkeys(['decode'] + names + ['sink'], 0.)
+
+        threads = [threading.Thread(
+            target=self.decode, args=(frame_generator,), daemon=True)]
+        threads += [
+            threading.Thread(
+                target=self.infer, args=(name, worker), daemon=True)
+            for name, worker in zip(names, self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        # the workers can finish out of order, so batches wait here until their turn
+        pending = {}
+        next_index = 0
+        running = len(self.workers)
+
+        try:
+            while running > 0:
+                item = self.get(self.result_queue)
+                if item is DONE:
+                    if self.stop.is_set():
+                        break
+                    running -= 1
+                    continue
+
+                index, frames, results = item
+                pending[index] = (frames, results)
+
+                while next_index in pending:
+                    frames, results = pending.pop(next_index)
+                    sink_start = time.perf_counter()
+                    sink(frames, results)
+                    busy += time.perf_counter() - sink_start
+                    next_index += 1
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+
+            self.busy['sink'] = busy
+            self.wall = time.perf_counter() - start
+
+        if self.errors:
+            raise self.errors[0]
+
+    def report(self):
+        """
+        Returns the utilization of each stage, the fraction of the run it spent working.
+        """
+        lines = [f'Pipeline: {self.wall:.2f}s']
+        for name, busy in self.busy.items():
+            utilization = busy / self.wall if self.wall else 0.
+            lines.append(f'  {name}: {busy:.2f}s busy, {utilization:.0%} utilization')
+
+        return '\n'.join(lines)
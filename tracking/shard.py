@@ -0,0 +1,217 @@
+import os
+import sys
+import tempfile
+import numpy as np
+import multiprocessing as mp
+import supervision as sv
+
+from dataclasses import replace
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from detect import detections, DetectionConfig, BALL_ID, REFEREE_ID
+from store import load, load_scenes, open_writer
+
+
+def split(total_frames, shards, overlap):
+    """
+    Splits the frames of the video into shards.
+
+    Each shard starts overlap frames before the end of the previous one,
+    which gives the tracker time to warm up and is used to match the tracking ids.
+    """
+    size = -(-total_frames // shards)
+
+    return [
+        (max(0, i * size - overlap), min(total_frames, (i + 1) * size))
+        for i in range(shards)
+        if i * size < total_frames
+    ]
+
+
+def run_shard(kwargs):
+    """
+    Runs the detections on a single shard in its own process.
+    """
+    detections(**kwargs)
+
+
+def match_tracks(previous, current, iou_threshold=0.5):
+    """
+    Matches the tracking ids of two runs over the same frames.
+
+    For every frame the boxes are paired by IoU, and the ids that are paired in
+    the most frames are matched. Returns a dictionary from the current ids to the previous ids.
+    """
+    votes = {}
+    for prev_detections, curr_detections in zip(previous, current):
+        prev_detections = prev_detections[prev_detections.class_id != BALL_ID]
+        curr_detections = curr_detections[curr_detections.class_id != BALL_ID]
+
+        if len(prev_detections) == 0 or len(curr_detections) == 0:
+            continue
+
+        iou = sv.box_iou_batch(curr_detections.xyxy, prev_detections.xyxy)
+        for i, j in enumerate(iou.argmax(axis=1)):
+            if iou[i, j] < iou_threshold:
+                continue
+
+            pair = (curr_detections.tracker_id[i], prev_detections.tracker_id[j])
+            votes[pair] = votes.get(pair, 0) + 1
+
+    # greedily pick the pairs seen in the most frames, one match per id
+    matches = {}
+    matched = set()
+    for (curr_id, prev_id), _ in sorted(votes.items(), key=lambda x: -x[1]):
+        if curr_id in matches or prev_id in matched:
+            continue
+        matches[curr_id] = prev_id
+        matched.add(prev_id)
+
+    return matches
+
+
+def teams_swapped(previous, current, matches):
+    """
+    Checks if the two team labels are swapped between two runs.
+
+    Each shard fits its own team classifier, so the team labels are arbitrary.
+    """
+    agree, swap = 0, 0
+    for prev_detections, curr_detections in zip(previous, current):
+        prev_teams = dict(zip(prev_detections.tracker_id, prev_detections.class_id))
+
+        for tracker_id, class_id in zip(curr_detections.tracker_id, curr_detections.class_id):
+            if tracker_id not in matches or class_id in [BALL_ID, REFEREE_ID]:
+                continue
+
+            prev_class_id = prev_teams.get(matches[tracker_id])
+            if prev_class_id == class_id:
+                agree += 1
+            elif prev_class_id not in [None, BALL_ID, REFEREE_ID]:
+                swap += 1
+
+    return swap > agree
+
+
+def relabel(frame_detections, frame_coordinates, ids, swap):
+    """
+    Changes the tracking ids and team labels of a single frame.
+    """
+    def tracker_id(i):
+        return ids.get(i, i)
+
+    def class_id(c):
+        if swap and c not in [BALL_ID, REFEREE_ID]:
+            return 3 - c
+        return c
+
+    if len(frame_detections) > 0:
+        frame_detections.tracker_id = np.array(
+            [tracker_id(i) for i in frame_detections.tracker_id])
+        frame_detections.class_id = np.array(
+            [class_id(c) for c in frame_detections.class_id])
+
+    # projected coordinates also hold the edges of the frame
+    if isinstance(frame_coordinates, tuple):
+        coords, edges = frame_coordinates
+        coords = [(tracker_id(i), class_id(c), xy) for i, c, xy in coords]
+        return frame_detections, (coords, edges)
+
+    coords = [(tracker_id(i), class_id(c), xy) for i, c, xy in frame_coordinates]
+    return frame_detections, coords
+
+
+def stitch_scenes(parts, overlap):
+    """
+    Merges the scene tags of the shards, taking the overlapping frames from the earlier shard like stitch.
+    """
+    scenes = parts[0]
+    for part in parts[1:]:
+        shared = min(overlap, len(part), len(scenes))
+        scenes = np.concatenate([scenes, part[shared:]])
+
+    return scenes
+
+
+def stitch(parts, overlap):
+    """
+    Merges the outputs of the shards into a single output.
+
+    The overlapping frames are taken from the earlier shard and the tracking ids
+    of each shard are matched to the previous one using the overlapping frames.
+    Ids that are not matched get new ids so they do not collide with earlier tracks.
+    """
+    detect, coordinates = parts[0]
+    last_id = max([max(d.tracker_id, default=-1) for d in detect], default=-1)
+
+    for part_detect, part_coordinates in parts[1:]:
+        shared = min(overlap, len(part_detect), len(detect))
+        previous = detect[len(detect) - shared:]
+        current = part_detect[:shared]
+
+        matches = match_tracks(previous, current)
+        swap = teams_swapped(previous, current, matches)
+
+        ids = {-1: -1}
+        for frame_detections in part_detect[shared:]:
+            for i in frame_detections.tracker_id:
+                if i in ids:
+                    continue
+                if i in matches:
+                    ids[i] = matches[i]
+                else:
+                    last_id += 1
+                    ids[i] = last_id
+
+        for frame_detections, frame_coordinates in zip(part_detect[shared:], part_coordinates[shared:]):
+            frame_detections, frame_coordinates = relabel(
+                frame_detections, frame_coordinates, ids, swap)
+            detect.append(frame_detections)
+            coordinates.append(frame_coordinates)
+
+    return detect, coordinates
+
+
+def sharded_detections(clip_path, players_path, ball_path, pkl_path, config=None, shards=2, overlap=50):
+    """
+    Runs the detections on shards of the video in separate processes and merges the outputs.
+
+    The shards overlap by overlap frames which are used to stitch the tracking ids together.
+    config holds the options of every shard, see DetectionConfig. If its threads is None,
+    the cores are split between the shards.
+    """
+    config = config or DetectionConfig()
+    video_info = sv.VideoInfo.from_video_path(clip_path)
+    segments = split(video_info.total_frames, shards, overlap)
+
+    if config.threads is None:
+        config = replace(config, threads=max(1, (os.cpu_count() or 1) // len(segments)))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        part_paths = [f'{tmp_dir}/part_{i}.pkl' for i in range(len(segments))]
+        jobs = [
+            dict(
+                clip_path=clip_path,
+                players_path=players_path,
+                ball_path=ball_path,
+                pkl_path=part_path,
+                config=config,
+                start=start,
+                end=end,
+            )
+            for part_path, (start, end) in zip(part_paths, segments)
+        ]
+
+        # spawn so every process initializes its own models and cuda context
+        with mp.get_context('spawn').Pool(len(jobs)) as pool:
+            pool.map(run_shard, jobs)
+
+        parts = [load(part_path) for part_path in part_paths]
+        scenes = stitch_scenes([load_scenes(part_path) for part_path in part_paths], overlap)
+
+    detect, coordinates = stitch(parts, overlap)
+
+    writer = open_writer(pkl_path, chunk_size=config.chunk_size)
+    for frame_detections, frame_coordinates, (live, cut) in zip(detect, coordinates, scenes):
+        writer.append(frame_detections, frame_coordinates, live=bool(live), cut=bool(cut))
+    writer.close()
@@ -0,0 +1,444 @@
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+import supervision as sv
+
+from supervision.tracker.byte_tracker.basetrack import BaseTrack
+from supervision.tracker.byte_tracker.core import STrack
+
+# columns with a row per detection
+ROW_COLUMNS = ['frame', 'tracker_id', 'class_id', 'xyxy', 'confidence', 'xy', 'interpolated']
+# columns with a row per frame
+FRAME_COLUMNS = ['edges', 'calibrated', 'live', 'cut']
+# values of the frame columns missing from stores written before they were added
+FRAME_DEFAULTS = dict(live=True, cut=False)
+
+
+def is_pickle(path):
+    """
+    Outputs with a .pkl extension are pickles, any other path is a store directory.
+    """
+    return str(path).endswith('.pkl')
+
+
+class StoreWriter:
+    """
+    Writes the tracking output as a store of columns split in chunks of frames.
+
+    Every chunk is a directory holding one .npy file per column, and index.json lists
+    the chunks that are complete. The chunks are written as soon as they are full,
+    so the output never has to be held in memory and a run that stops early keeps
+    every chunk written before it stopped.
+    """
+
+    def __init__(self, path, chunk_size=1000):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.frames = 0
+        self.projected = None
+        self.rows = []
+
+        os.makedirs(path, exist_ok=True)
+        self.write_index()
+
+    def append(self, detections, coords, live=True, cut=False):
+        """
+        Adds the detections and coordinates of the next frame.
+
+        live is False for frames that do not show the pitch and cut is True for the first frame of a shot.
+        """
+        # projected coordinates also hold the edges of the frame
+        projected = isinstance(coords, tuple)
+        if self.projected is None:
+            self.projected = projected
+
+        n = len(detections)
+        xy = np.full((n, 2), np.nan)
+        edges = np.full((4, 2), np.nan)
+        calibrated = False
+
+        if projected:
+            points, frame_edges = coords
+            if len(frame_edges) > 0:
+                xy[:] = np.reshape([point for _, _, point in points], (n, 2))
+                edges[:] = frame_edges
+                calibrated = True
+
+        confidence = detections.confidence
+        if confidence is None:
+            confidence = np.full(n, np.nan)
+
+        # detections moved from an earlier frame instead of detected
+        interpolated = detections.data.get('interpolated', np.zeros(n, dtype=bool))
+
+        self.rows.append(dict(
+            frame=np.full(n, self.frames, dtype=np.int64),
+            tracker_id=np.asarray(detections.tracker_id, dtype=np.int64).reshape(n),
+            class_id=np.asarray(detections.class_id, dtype=np.int64).reshape(n),
+            xyxy=np.asarray(detections.xyxy, dtype=np.float32).reshape(n, 4),
+            confidence=np.asarray(confidence, dtype=np.float32).reshape(n),
+            xy=xy,
+            interpolated=np.asarray(interpolated, dtype=bool).reshape(n),
+            edges=edges[None],
+            calibrated=np.array([calibrated]),
+            live=np.array([live]),
+            cut=np.array([cut]),
+        ))
+        self.frames += 1
+
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the frames that are not written yet as a new chunk.
+        """
+        if not self.rows:
+            return
+
+        start = self.frames - len(self.rows)
+        name = f'chunk_{len(self.chunks):06d}'
+        os.makedirs(f'{self.path}/{name}', exist_ok=True)
+
+        for column in ROW_COLUMNS + FRAME_COLUMNS:
+            values = np.concatenate([row[column] for row in self.rows])
+            np.save(f'{self.path}/{name}/{column}.npy', values)
+
+        self.chunks.append(dict(
+            name=name,
+            start=start,
+            end=self.frames,
+            rows=int(sum(len(row['frame']) for row in self.rows)),
+        ))
+        self.rows = []
+        self.write_index()
+
+    def write_index(self):
+        # the index is replaced at once so it never lists a chunk that is not fully written
+        index = dict(
+            frames=self.chunks[-1]['end'] if self.chunks else 0,
+            projected=bool(self.projected),
+            chunk_size=self.chunk_size,
+            chunks=self.chunks,
+        )
+        with open(f'{self.path}/index.json.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(f'{self.path}/index.json.tmp', f'{self.path}/index.json')
+
+    def close(self):
+        self.flush()
+
+
+def scenes_path(path):
+    """
+    Returns the path of the scene tags saved next to a pickle.
+    """
+    return f'{path}.scenes.npy'
+
+
+class PickleWriter:
+    """
+    Writes the tracking output as a single pickle of the detections and coordinates when closed.
+
+    The scene tags of the frames are saved next to it, so the pickle keeps its format.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.detect = []
+        self.coordinates = []
+        self.scenes = []
+
+    def append(self, detections, coords, live=True, cut=False):
+        self.detect.append(detections)
+        self.coordinates.append(coords)
+        self.scenes.append((live, cut))
+
+    def close(self):
+        with open(self.path, 'wb') as f:
+            pickle.dump((self.detect, self.coordinates), f)
+        np.save(scenes_path(self.path), np.array(self.scenes, dtype=bool).reshape(-1, 2))
+
+
+def open_writer(path, chunk_size=1000):
+    """
+    Returns a writer for the tracking output, a pickle if the path ends with .pkl or a store otherwise.
+    """
+    if is_pickle(path):
+        return PickleWriter(path)
+
+    return StoreWriter(path, chunk_size=chunk_size)
+
+
+class TrackStore:
+    """
+    Reads a store written by StoreWriter.
+
+    The columns are memory-mapped, so reading a range of frames only loads the
+    chunks that overlap it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(f'{path}/index.json') as f:
+            self.index = json.load(f)
+
+        self.frames = self.index['frames']
+        self.projected = self.index['projected']
+
+    def __len__(self):
+        return self.frames
+
+    def read(self, start=0, end=None):
+        """
+        Returns the columns of the frames between start and end.
+
+        The detection columns have a row per detection and the frame column gives the
+        frame of each row. edges and calibrated have a row per frame.
+        """
+        end = self.frames if end is None else min(end, self.frames)
+
+        parts = {column: [] for column in ROW_COLUMNS + FRAME_COLUMNS}
+        for chunk in self.index['chunks']:
+            if chunk['end'] <= start or chunk['start'] >= end:
+                continue
+
+            columns = {
+                column: self.load_column(chunk, column)
+                for column in ROW_COLUMNS + FRAME_COLUMNS
+            }
+
+            # the rows are sorted by frame, so the range is a slice of the chunk
+            first, last = np.searchsorted(
+                columns['frame'], [max(start, chunk['start']), min(end, chunk['end'])])
+            for column in ROW_COLUMNS:
+                parts[column].append(columns[column][first:last])
+
+            first = max(start, chunk['start']) - chunk['start']
+            last = min(end, chunk['end']) - chunk['start']
+            for column in FRAME_COLUMNS:
+                parts[column].append(columns[column][first:last])
+
+        empty = dict(
+            frame=np.zeros(0, dtype=np.int64),
+            tracker_id=np.zeros(0, dtype=np.int64),
+            class_id=np.zeros(0, dtype=np.int64),
+            xyxy=np.zeros((0, 4), dtype=np.float32),
+            confidence=np.zeros(0, dtype=np.float32),
+            xy=np.zeros((0, 2)),
+            interpolated=np.zeros(0, dtype=bool),
+            edges=np.zeros((0, 4, 2)),
+            calibrated=np.zeros(0, dtype=bool),
+            live=np.zeros(0, dtype=bool),
+            cut=np.zeros(0, dtype=bool),
+        )
+
+        return {
+            column: np.concatenate(values) if values else empty[column]
+            for column, values in parts.items()
+        }
+
+    def load_column(self, chunk, column):
+        """
+        Returns the memory-mapped column of the chunk, filled with its default if the chunk does not have it.
+        """
+        path = f'{self.path}/{chunk["name"]}/{column}.npy'
+        if not os.path.exists(path) and column in FRAME_DEFAULTS:
+            return np.full(chunk['end'] - chunk['start'], FRAME_DEFAULTS[column])
+
+        return np.load(path, mmap_mode='r')
+
+    def scenes(self, start=0, end=None):
+        """
+        Returns whether each frame between start and end shows the pitch and starts a shot, as an Nx2 array.
+        """
+        columns = self.read(start, end)
+
+        return np.stack([columns['live'], columns['cut']], axis=1)
+
+    def split(self, columns, start, end):
+        """
+        Returns the slice of the rows of each frame between start and end.
+        """
+        bounds = np.searchsorted(columns['frame'], np.arange(start, end + 1))
+
+        return [slice(first, last) for first, last in zip(bounds[:-1], bounds[1:])]
+
+    def detections(self, start=0, end=None):
+        """
+        Returns the detections of each frame between start and end.
+        """
+        end = self.frames if end is None else min(end, self.frames)
+        columns = self.read(start, end)
+
+        detect = []
+        for rows in self.split(columns, start, end):
+            detections = sv.Detections(
+                xyxy=np.array(columns['xyxy'][rows]),
+                confidence=np.array(columns['confidence'][rows]),
+                class_id=np.array(columns['class_id'][rows]),
+                tracker_id=np.array(columns['tracker_id'][rows]),
+                data={'interpolated': np.array(columns['interpolated'][rows])},
+            )
+            detect.append(detections)
+
+        return detect
+
+    def coordinates(self, start=0, end=None):
+        """
+        Returns the coordinates of each frame between start and end in the format of the pickle.
+
+        Projected frames are a list of (tracker_id, class_id, xy) and the edges of the frame,
+        both empty if the calibration failed. Otherwise they are a list of (tracker_id, class_id, xyxy).
+        """
+        end = self.frames if end is None else min(end, self.frames)
+        columns = self.read(start, end)
+
+        coordinates = []
+        for i, rows in enumerate(self.split(columns, start, end)):
+            ids = zip(columns['tracker_id'][rows], columns['class_id'][rows])
+
+            if not self.projected:
+                coordinates.append([
+                    (tracker_id, class_id, xyxy)
+                    for (tracker_id, class_id), xyxy in zip(ids, np.array(columns['xyxy'][rows]))
+                ])
+            elif columns['calibrated'][i]:
+                coords = [
+                    (tracker_id, class_id, xy)
+                    for (tracker_id, class_id), xy in zip(ids, np.array(columns['xy'][rows]))
+                ]
+                coordinates.append((coords, np.array(columns['edges'][i])))
+            else:
+                coordinates.append(([], []))
+
+        return coordinates
+
+
+def checkpoint_path(path):
+    """
+    Returns the path of the checkpoint of a run writing its output to path.
+    """
+    return f'{str(path).rstrip("/")}.ckpt'
+
+
+def save_checkpoint(path, state):
+    """
+    Saves the state of a run next to its output.
+
+    ByteTrack counts its ids on the track classes rather than on the tracker, so the counters
+    are saved with the state, otherwise a resumed run would give the new tracks the ids of earlier ones.
+    The checkpoint is replaced at once, so a run killed while saving keeps the previous one.
+    """
+    state = dict(state, track_ids=(BaseTrack._count, STrack._external_count))
+    with open(f'{checkpoint_path(path)}.tmp', 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(f'{checkpoint_path(path)}.tmp', checkpoint_path(path))
+
+
+def load_checkpoint(path):
+    """
+    Returns the state saved by the last checkpoint of a run writing its output to path, or None.
+
+    The id counters of ByteTrack are set back to the ones saved with the state.
+    """
+    if not os.path.exists(checkpoint_path(path)):
+        return None
+
+    with open(checkpoint_path(path), 'rb') as f:
+        state = pickle.load(f)
+
+    # checkpoints saved before the counters were added do not have them
+    if 'track_ids' in state:
+        BaseTrack._count, STrack._external_count = state.pop('track_ids')
+
+    return state
+
+
+def load(path):
+    """
+    Returns the detections and coordinates of every frame from a pickle or a store.
+    """
+    if is_pickle(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    store = TrackStore(path)
+    return store.detections(), store.coordinates()
+
+
+def load_detections(path):
+    """
+    Returns the detections of every frame from a pickle or a store.
+    """
+    if is_pickle(path):
+        return load(path)[0]
+
+    return TrackStore(path).detections()
+
+
+def load_coordinates(path):
+    """
+    Returns the coordinates of every frame from a pickle or a store.
+    """
+    if is_pickle(path):
+        return load(path)[1]
+
+    return TrackStore(path).coordinates()
+
+
+def load_scenes(path):
+    """
+    Returns whether each frame shows the pitch and starts a shot, as an Nx2 array, from a pickle or a store.
+
+    Outputs written without the scene tags have every frame live and no cuts.
+    """
+    if not is_pickle(path):
+        return TrackStore(path).scenes()
+
+    if os.path.exists(scenes_path(path)):
+        return np.load(scenes_path(path))
+
+    scenes = np.zeros((len(load(path)[0]), 2), dtype=bool)
+    scenes[:, 0] = True
+    return scenes
+
+
+def convert(pkl_path, store_path, chunk_size=1000):
+    """
+    Converts a pickle of detections and coordinates to a store.
+    """
+    detect, coordinates = load(pkl_path)
+    scenes = load_scenes(pkl_path)
+
+    writer = StoreWriter(store_path, chunk_size=chunk_size)
+    for detections, coords, (live, cut) in zip(detect, coordinates, scenes):
+        writer.append(detections, coords, live=bool(live), cut=bool(cut))
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts a detections pickle to a store')
+
+    parser.add_argument(
+        'pkl_path',
+        type=str,
+        help='Path to the detections pkl file',
+    )
+    parser.add_argument(
+        'store_path',
+        type=str,
+        help='Path to the store directory to write',
+    )
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        default=1000,
+        help='Number of frames in each chunk',
+    )
+
+    args = parser.parse_args()
+    convert(args.pkl_path, args.store_path, chunk_size=args.chunk_size)
@@ -0,0 +1,73 @@
+import os
+import sys
+import numpy as np
+import supervision as sv
+
+from supervision.tracker.byte_tracker.basetrack import BaseTrack
+from supervision.tracker.byte_tracker.core import STrack
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from store import save_checkpoint, load_checkpoint
+from utils.scene import SceneClassifier
+
+
+def players(frame):
+    """
+    Returns the boxes of three players walking right, replaced by three other players from frame 70.
+    """
+    x = 100 + 200 * np.arange(3) + 2 * frame
+    y = 100 if frame < 70 else 600
+    xyxy = np.stack([x, np.full(3, y), x + 40, np.full(3, y + 80)], axis=1).astype(float)
+
+    return sv.Detections(xyxy=xyxy, confidence=np.full(3, 0.9), class_id=np.ones(3, dtype=int))
+
+
+def track(tracker, frames):
+    return [tracker.update_with_detections(players(frame)).tracker_id.tolist() for frame in frames]
+
+
+def test_resumed_tracking_ids(tmp_path):
+    pkl_path = str(tmp_path / 'detections.pkl')
+
+    tracker = sv.ByteTrack()
+    tracker.reset()
+    expected = track(tracker, range(100))
+
+    tracker = sv.ByteTrack()
+    tracker.reset()
+    resumed = track(tracker, range(60))
+    save_checkpoint(pkl_path, dict(frame=60, tracker=tracker))
+
+    # a new process starts with the id counters of ByteTrack at zero
+    BaseTrack.reset_counter()
+    STrack.reset_external_counter()
+
+    state = load_checkpoint(pkl_path)
+    assert state['frame'] == 60
+    resumed += track(state['tracker'], range(60, 100))
+
+    assert resumed == expected
+    assert set(expected[0]).isdisjoint(expected[-1])
+
+
+def test_resumed_scene_tags():
+    # a shot of the pitch with a cut to a close-up on frame 10, the first frame after the checkpoint
+    rng = np.random.default_rng(0)
+    pitch = np.zeros((360, 640, 3), dtype=np.uint8)
+    pitch[...] = (40, 160, 40)
+    close_up = rng.integers(0, 255, (360, 640, 3), dtype=np.uint8)
+    frames = [pitch] * 10 + [close_up] * 5
+
+    scene = SceneClassifier()
+    expected = [scene(frame) for frame in frames]
+
+    scene = SceneClassifier()
+    resumed = [scene(frame) for frame in frames[:10]]
+    scene_hist = scene.histogram(frames[9])
+
+    scene = SceneClassifier()
+    scene.prev_hist = scene_hist
+    resumed += [scene(frame) for frame in frames[10:]]
+
+    assert resumed == expected
+    assert expected[10] == (False, True)
@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('sklearn')
+pytest.importorskip('tqdm')
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detect import DetectionConfig
+
+
+def test_pitch_filter_threaded():
+    # the crop of a batch comes from the calibration of the frame before it, which a threaded run does not wait for
+    with pytest.raises(ValueError):
+        DetectionConfig(pitch_filter=True, threaded=True)
+
+    assert DetectionConfig(pitch_filter=True).pitch_filter
+    assert DetectionConfig(threaded=True).threaded
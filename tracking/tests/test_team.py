@@ -0,0 +1,27 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('sklearn')
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.team import TeamCache
+
+
+def test_team_cache_id_switch():
+    # the tracker id switches to a player of the other team on frame 300
+    cache = TeamCache(min_votes=5, min_agreement=0.8, refresh=250)
+    tracker_ids = np.array([7])
+
+    teams = []
+    for frame in range(800):
+        labels, missing = cache.lookup(tracker_ids)
+        if missing.any():
+            labels[missing] = cache.update(tracker_ids[missing], np.array([int(frame >= 300)]))
+        teams.append(int(labels[0]))
+
+    # the switch is seen on the first check after it, at most refresh frames later
+    assert teams[:300] == [0] * 300
+    assert teams[300 + cache.refresh:] == [1] * (500 - cache.refresh)
@@ -0,0 +1,165 @@
+import os
+import warnings
+import numpy as np
+
+import torch
+
+# backends the models can run on, the exported ones only run on the CPU
+BACKENDS = ['torch', 'onnx', 'openvino']
+
+
+def default_device():
+    """
+    Returns the device PyTorch models run on, the GPU if there is one.
+    """
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def set_threads(threads=None):
+    """
+    Sets the number of threads PyTorch uses on the CPU, the default is kept if threads is None.
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+
+class ExportedModel:
+    """
+    Runs an exported ONNX graph with ONNX Runtime or OpenVINO.
+
+    It is called like the PyTorch model it was exported from, with a tensor
+    of frames, and returns a tensor, so it can be used in place of it.
+    """
+
+    def __init__(self, onnx_path, backend='onnx', threads=None):
+        self.backend = backend
+
+        if backend == 'onnx':
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            if threads is not None:
+                options.intra_op_num_threads = threads
+            self.session = ort.InferenceSession(
+                onnx_path, options, providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+
+        elif backend == 'openvino':
+            import openvino as ov
+
+            core = ov.Core()
+            # the compiled model is cached next to the graph so it is only compiled once
+            core.set_property({'CACHE_DIR': f'{onnx_path}_openvino_cache'})
+
+            config = {}
+            if threads is not None:
+                config['INFERENCE_NUM_THREADS'] = threads
+            self.compiled = core.compile_model(onnx_path, 'CPU', config)
+
+        else:
+            raise ValueError(f'Unknown exported backend {backend}')
+
+    def __call__(self, x):
+        x = x.detach().cpu().numpy().astype(np.float32)
+
+        if self.backend == 'onnx':
+            output = self.session.run(None, {self.input_name: x})[0]
+        else:
+            output = self.compiled(x)[0]
+
+        return torch.from_numpy(np.asarray(output))
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+
+def export_onnx(model, onnx_path, input_shape=(1, 3, 540, 960)):
+    """
+    Exports a PyTorch model to an ONNX graph with a dynamic batch size.
+    """
+    model = model.cpu().eval()
+    dummy = torch.zeros(input_shape)
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            dummy,
+            onnx_path,
+            input_names=['input'],
+            output_names=['output'],
+            dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+            opset_version=17,
+        )
+
+
+def quantized_path(weights_path):
+    """
+    Returns the path of the INT8 graph of the model with these weights.
+    """
+    return f'{weights_path}.int8.onnx'
+
+
+def load_exported(model, weights_path, backend='torch', threads=None, quantized=False):
+    """
+    Returns the model running on the backend.
+
+    The model is exported once to an ONNX graph next to its weights, and later runs
+    reuse it. If the backend is not installed or the export fails, the PyTorch model
+    is used on the CPU instead. If quantized is True, the INT8 graph is used if it was built.
+    """
+    if backend == 'torch':
+        return model
+
+    onnx_path = f'{weights_path}.onnx'
+    if quantized:
+        if os.path.exists(quantized_path(weights_path)):
+            onnx_path = quantized_path(weights_path)
+        else:
+            warnings.warn(f'No INT8 graph for {weights_path}, run utils/quantize.py first')
+
+    try:
+        if not os.path.exists(onnx_path):
+            export_onnx(model, onnx_path)
+        return ExportedModel(onnx_path, backend, threads=threads)
+    except Exception as e:
+        warnings.warn(f'Could not run {weights_path} with {backend}, using PyTorch on the CPU: {e}')
+        return model.cpu().eval()
+
+
+def exported_detector_path(path, backend):
+    """
+    Returns the path ultralytics exports a YOLO model to for the backend.
+    """
+    stem = os.path.splitext(path)[0]
+    if backend == 'onnx':
+        return f'{stem}.onnx'
+
+    return f'{stem}_openvino_model'
+
+
+def load_detector(path, backend='torch'):
+    """
+    Returns the YOLO model at path running on the backend.
+
+    The model is exported once by ultralytics next to its weights, and later runs
+    reuse it. If the backend is not installed or the export fails, the PyTorch model
+    is used instead. ultralytics creates the ONNX Runtime or OpenVINO session itself with
+    no thread setting, so the exported model uses the default number of threads of its runtime.
+    """
+    from ultralytics import YOLO
+
+    model = YOLO(path)
+    if backend == 'torch':
+        return model
+
+    exported = exported_detector_path(path, backend)
+    try:
+        if not os.path.exists(exported):
+            exported = model.export(format=backend, dynamic=True)
+        return YOLO(exported, task=model.task)
+    except Exception as e:
+        warnings.warn(f'Could not run {path} with {backend}, using PyTorch: {e}')
+        return model
@@ -0,0 +1,227 @@
+import os
+import sys
+import cv2
+import numpy as np
+import supervision as sv
+
+cdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(cdir)
+from motion import pitch_mask
+
+
+def tile_origins(length, tile, overlap):
+    """
+    Returns the starts of the tiles covering a length, overlapping by at least overlap of a tile.
+    """
+    if length <= tile:
+        return [0]
+
+    count = int(np.ceil((length - tile) / (tile * (1 - overlap)))) + 1
+    return np.linspace(0, length - tile, count).round().astype(int).tolist()
+
+
+def pitch_tiles(frame, tile=640, overlap=0.2, min_pitch=0.05, scale=0.25):
+    """
+    Returns the top left corners of the tiles of the frame that show the pitch.
+
+    Tiles with less than min_pitch of green pixels only show the stands or graphics and are skipped.
+    The green pixels are counted on the frame resized by scale.
+    """
+    h, w = frame.shape[:2]
+    tile = min(tile, h, w)
+
+    mask = pitch_mask(cv2.resize(frame, None, fx=scale, fy=scale)) > 0
+
+    tiles = []
+    for y in tile_origins(h, tile, overlap):
+        for x in tile_origins(w, tile, overlap):
+            window = mask[int(y * scale):int((y + tile) * scale), int(x * scale):int((x + tile) * scale)]
+            if window.size > 0 and window.mean() >= min_pitch:
+                tiles.append((x, y))
+
+    return tiles, tile
+
+
+def tiled_detections(frame, model, confidence=0.5, tile=640, overlap=0.2, min_pitch=0.05, classes=None):
+    """
+    Detects the ball in overlapping tiles of the frame at the resolution of the tiles.
+
+    All the tiles showing the pitch are sent to the model as one batch, the boxes
+    are moved back to the frame and the boxes found in several tiles are merged with NMS.
+    classes restricts the model to these class ids, for models detecting more than the ball.
+    """
+    tiles, tile = pitch_tiles(frame, tile, overlap, min_pitch)
+    if not tiles:
+        return sv.Detections.empty()
+
+    crops = [frame[y:y + tile, x:x + tile] for x, y in tiles]
+    results = model(crops, conf=confidence, imgsz=tile, classes=classes, verbose=False)
+
+    detections = []
+    for (x, y), result in zip(tiles, results):
+        tile_detections = sv.Detections.from_ultralytics(result)
+        tile_detections.xyxy = tile_detections.xyxy + np.array([x, y, x, y], dtype=tile_detections.xyxy.dtype)
+        detections.append(tile_detections)
+
+    detections = sv.Detections.merge(detections)
+    if len(detections) == 0:
+        return detections
+
+    return detections.with_nms(threshold=0.5, class_agnostic=True)
+
+
+class BallSearch:
+    """
+    Looks for the ball around where it is expected instead of in the whole frame.
+
+    The position of the ball is predicted with a constant velocity from the last
+    frames it was found in, and the ball model runs on a window of the frame centred
+    on the prediction at the window's own resolution, so the ball is not shrunk with
+    the rest of the frame. The window grows by growth on every frame the ball is
+    missed, and after max_misses misses in a row the whole frame is searched again.
+
+    If tiles is True, the whole frame is searched in tiles of tile_size pixels overlapping by
+    tile_overlap, so the ball is found at full resolution even when there is no prediction.
+    """
+
+    def __init__(self, model, confidence=0.5, window=640, growth=1.5, max_misses=5, smoothing=0.5, tiles=False, tile_size=640, tile_overlap=0.2, classes=None, imgsz=640):
+        """
+        model is the ball model and confidence its confidence threshold.
+        classes restricts the model to these class ids, for a combined model detecting the players too.
+        window is the size in pixels of the square searched around the prediction.
+        imgsz is the input size of the model on the whole frame, a grown window is run at most at this
+        size so a window search never costs more than searching the whole frame.
+        smoothing is the weight of the current frame in the velocity.
+        """
+        self.tiles = tiles
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.classes = classes
+
+        self.model = model
+        self.confidence = confidence
+        self.window = window
+        self.growth = growth
+        self.max_misses = max_misses
+        self.smoothing = smoothing
+        self.imgsz = imgsz
+
+        self.position = None
+        self.velocity = np.zeros(2)
+        self.misses = 0
+
+        self.roi_searches = 0
+        self.full_searches = 0
+        self.found = 0
+
+    def __getstate__(self):
+        # the model is set again when the search is restored from a checkpoint
+        state = self.__dict__.copy()
+        state['model'] = None
+        return state
+
+    def reset(self):
+        """
+        Forgets where the ball was, after a cut the whole frame is searched again.
+        """
+        self.position = None
+        self.velocity = np.zeros(2)
+        self.misses = 0
+
+    def predict(self):
+        """
+        Returns the expected center of the ball in the next frame.
+        """
+        return self.position + self.velocity * (self.misses + 1)
+
+    def full(self, frame):
+        """
+        Runs the ball model on the whole frame.
+        """
+        self.full_searches += 1
+        if self.tiles:
+            return tiled_detections(
+                frame,
+                self.model,
+                confidence=self.confidence,
+                tile=self.tile_size,
+                overlap=self.tile_overlap,
+                classes=self.classes,
+            )
+
+        result = self.model(frame, conf=self.confidence, classes=self.classes, verbose=False)[0]
+
+        return sv.Detections.from_ultralytics(result)
+
+    def roi(self, frame):
+        """
+        Runs the ball model on the window around the predicted position.
+        """
+        self.roi_searches += 1
+
+        h, w = frame.shape[:2]
+        size = int(self.window * self.growth ** self.misses)
+        size = min(size, h, w)
+
+        # keep the window inside the frame
+        x, y = self.predict()
+        x1 = int(np.clip(x - size / 2, 0, w - size))
+        y1 = int(np.clip(y - size / 2, 0, h - size))
+
+        crop = frame[y1:y1 + size, x1:x1 + size]
+        result = self.model(
+            crop, conf=self.confidence, imgsz=min(size, self.imgsz), classes=self.classes, verbose=False)[0]
+
+        detections = sv.Detections.from_ultralytics(result)
+        detections.xyxy = detections.xyxy + np.array([x1, y1, x1, y1], dtype=detections.xyxy.dtype)
+
+        return detections
+
+    def update(self, detections):
+        """
+        Updates the position and velocity of the ball with the detections of the frame.
+        """
+        if len(detections) == 0:
+            self.misses += 1
+            return
+
+        best = detections.confidence.argmax()
+        x1, y1, x2, y2 = detections.xyxy[best]
+        position = np.array([(x1 + x2) / 2, (y1 + y2) / 2])
+
+        if self.position is not None:
+            velocity = (position - self.position) / (self.misses + 1)
+            self.velocity = self.smoothing * velocity + (1 - self.smoothing) * self.velocity
+
+        self.position = position
+        self.misses = 0
+        self.found += 1
+
+    def __call__(self, frame):
+        """
+        Returns the ball detections of the frame.
+        """
+        if self.position is None or self.misses >= self.max_misses:
+            detections = self.full(frame)
+            if len(detections) == 0:
+                # start over from the next ball found
+                self.position = None
+                self.velocity = np.zeros(2)
+        else:
+            detections = self.roi(frame)
+
+        self.update(detections)
+
+        return detections
+
+    def report(self):
+        """
+        Returns the number of window and full frame searches.
+        """
+        searches = self.roi_searches + self.full_searches
+        rate = self.found / searches if searches else 0.
+
+        return (
+            f'Ball search: {self.roi_searches} window searches, {self.full_searches} '
+            f'full frame searches, ball found in {rate:.0%} of frames'
+        )
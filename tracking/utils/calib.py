@@ -260,7 +260,7 @@ class FramebyFrameCalib:
             self.position = np.linalg.inv(
                 R) @ self.position + np.array([w/2, 0, 0])
 
-    def get_cam_params(self, mode='full', use_ransac=0, refine=False):
+    def get_cam_params(self, mode='full', use_ransac=0, refine=False, guess=None):
         flags = cv2.CALIB_FIX_PRINCIPAL_POINT | cv2.CALIB_FIX_ASPECT_RATIO
         flags = flags | cv2.CALIB_FIX_TANGENT_DIST | \
             cv2.CALIB_FIX_S1_S2_S3_S4 | cv2.CALIB_FIX_TAUX_TAUY
@@ -273,10 +273,20 @@ class FramebyFrameCalib:
         if len(self.obj_pts) == 0:
             return None, None
 
+        # start from the intrinsics of the guess, usually the previous frame
+        camera_matrix = None
+        if guess is not None:
+            flags = flags | cv2.CALIB_USE_INTRINSIC_GUESS
+            camera_matrix = np.array([
+                [guess['x_focal_length'], 0, guess['principal_point'][0]],
+                [0, guess['y_focal_length'], guess['principal_point'][1]],
+                [0, 0, 1],
+            ])
+
         ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(self.obj_pts, self.img_pts,
                                                            (self.image_width,
                                                             self.image_height),
-                                                           None, None, flags=flags)
+                                                           camera_matrix, None, flags=flags)
         if ret:
             self.calibration = mtx
             R, _ = cv2.Rodrigues(rvecs[0])
@@ -286,7 +296,9 @@ class FramebyFrameCalib:
             if self.ord_pts[0] != 0:
                 self.change_plane_coords()
 
-            if refine:
+            if guess is not None:
+                self.refine_from_guess(mode, dist, guess)
+            elif refine:
                 obj_pts, img_pts = self.get_correspondences(mode)
                 rvec, _ = cv2.Rodrigues(self.rotation)
                 tvec = -self.rotation @ self.position
@@ -320,14 +332,34 @@ class FramebyFrameCalib:
         else:
             return None, None
 
+    def refine_from_guess(self, mode, dist, guess):
+        """
+        Refines the pose with solvePnP starting from the pose of the guess.
+        Keeps the pose from the calibration if there are not enough points or the solver fails.
+        """
+        obj_pts, img_pts = self.get_correspondences(mode)
+        if len(obj_pts) < 4:
+            return
+
+        rotation = np.array(guess['rotation_matrix'])
+        rvec, _ = cv2.Rodrigues(rotation)
+        tvec = -rotation @ np.array(guess['position_meters'], dtype=float).ravel()
+
+        ok, rvec, tvec = cv2.solvePnP(obj_pts, img_pts, self.calibration, dist, rvec, tvec.reshape(3, 1),
+                                      useExtrinsicGuess=True, flags=cv2.SOLVEPNP_ITERATIVE)
+        if ok:
+            self.rotation, _ = cv2.Rodrigues(rvec)
+            self.position = (-np.transpose(self.rotation) @ tvec).ravel()
+
     def get_homography_from_ground_plane(self, use_ransac=5., inverse=False):
         self.get_per_plane_correspondences(
             mode='ground_plane', use_ransac=use_ransac)
         obj_pts, img_pts = self.get_correspondences('ground_plane')
 
         if len(obj_pts) >= 4:
+            # the ground plane points all have z = 0
             H, mask = cv2.findHomography(
-                obj_pts, img_pts, cv2.RANSAC, use_ransac)
+                obj_pts[:, :2], img_pts, cv2.RANSAC, use_ransac)
 
             if H is None:
                 return None
@@ -339,6 +371,24 @@ class FramebyFrameCalib:
         else:
             return None
 
+    def get_homography_with_error(self, use_ransac=5.):
+        """
+        Returns the homography from the ground plane to the image and its
+        mean reprojection error in pixels over the RANSAC inliers.
+        """
+        H = self.get_homography_from_ground_plane(use_ransac=use_ransac)
+        if H is None:
+            return None, None
+
+        obj_pts, img_pts = self.get_correspondences('ground_plane')
+        proj_pts = cv2.perspectiveTransform(obj_pts[:, None, :2], H)[:, 0]
+        errors = np.linalg.norm(proj_pts - img_pts, axis=1)
+
+        inliers = errors <= use_ransac
+        rep_err = errors[inliers].mean() if inliers.any() else errors.mean()
+
+        return H, rep_err
+
     def get_homography_from_3D_projection(self, use_ransac=5., inverse=False):
         cam_params, ret = self.get_cam_params(
             mode='full', use_ransac=use_ransac)
@@ -370,6 +420,21 @@ class FramebyFrameCalib:
         else:
             return H
 
+    def temporal_voting(self, previous=None, max_rep_err=10.):
+        """
+        Tries the mode and RANSAC threshold that won the voting on the previous frame,
+        seeding the solver with the previous camera parameters.
+        Runs the full voting if there is no previous result or its reprojection error is too high.
+        """
+        if previous is not None:
+            cam_params, ret = self.get_cam_params(
+                mode=previous['mode'], use_ransac=previous['use_ransac'], guess=previous['cam_params'])
+            if ret and ret <= max_rep_err:
+                return {'mode': previous['mode'], 'use_ransac': previous['use_ransac'], 'rep_err': ret,
+                        'cam_params': cam_params, 'calib_plane': self.ord_pts[0]}
+
+        return self.heuristic_voting()
+
     def heuristic_voting(self):
         final_results = []
         for mode in ['full', 'ground_plane', 'main']:
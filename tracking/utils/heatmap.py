@@ -1,8 +1,6 @@
-import copy
 import torch
 import numpy as np
 
-from scipy.stats import linregress
 from typing import List, Tuple
 
 
@@ -150,6 +148,20 @@ def generate_gaussian_array_vectorized_l(num_matrices, keypoints, original_size,
     return matrices_combined
 
 
+def peaks_to_coords(scores, indices, scale, return_scores=True):
+    """
+    Returns the (u, v) coordinates of the peaks scaled to the frame, followed by their scores,
+    as a NxCxKx3 tensor on the CPU, or NxCxKx2 without the scores.
+    """
+    # the indices are (row, column), the coordinates (column, row)
+    coords = indices.flip(-1) * scale
+    if return_scores:
+        coords = torch.cat([coords.float(), scores.unsqueeze(-1).float()], dim=-1)
+
+    #  moving them to CPU once at the end to avoid multiple GPU-mem accesses!
+    return coords.detach().cpu()
+
+
 def get_keypoints_from_heatmap_batch_maxpool(
         heatmap: torch.Tensor,
         scale: int = 2,
@@ -202,27 +214,7 @@ def get_keypoints_from_heatmap_batch_maxpool(
     #  remove top-k that are not local maxima and threshold (if required)
     # thresholding shouldn't be done during training
 
-    #  moving them to CPU now to avoid multiple GPU-mem accesses!
-    indices = indices.detach().cpu().numpy()
-    scores = scores.detach().cpu().numpy()
-    filtered_indices = [[[]
-                         for _ in range(n_channels)] for _ in range(batch_size)]
-
-    # have to do this manually as the number of maxima for each channel can be different
-    for batch_idx in range(batch_size):
-        for channel_idx in range(n_channels):
-            candidates = indices[batch_idx, channel_idx]
-            locs = []
-            for candidate_idx in range(candidates.shape[0]):
-                # convert to (u,v)
-                loc = candidates[candidate_idx][::-1] * scale
-                loc = loc.tolist()
-                if return_scores:
-                    loc.append(scores[batch_idx, channel_idx, candidate_idx])
-                locs.append(loc)
-            filtered_indices[batch_idx][channel_idx] = locs
-
-    return torch.tensor(filtered_indices)
+    return peaks_to_coords(scores, indices, scale, return_scores)
 
 
 def get_keypoints_from_heatmap_batch_maxpool_l(
@@ -272,162 +264,143 @@ def get_keypoints_from_heatmap_batch_maxpool_l(
     #  remove top-k that are not local maxima and threshold (if required)
     # thresholding shouldn't be done during training
 
-    #  moving them to CPU now to avoid multiple GPU-mem accesses!
-    indices = indices.detach().cpu().numpy()
-    scores = scores.detach().cpu().numpy()
-    filtered_indices = [[[]
-                         for _ in range(n_channels)] for _ in range(batch_size)]
-
-    # have to do this manually as the number of maxima for each channel can be different
-    for batch_idx in range(batch_size):
-        for channel_idx in range(n_channels):
-            candidates = indices[batch_idx, channel_idx]
-            locs = []
-            for candidate_idx in range(candidates.shape[0]):
-                # convert to (u,v)
-                loc = candidates[candidate_idx][::-1] * scale
-                loc = loc.tolist()
-                if return_scores:
-                    loc.append(scores[batch_idx, channel_idx, candidate_idx])
-                locs.append(loc)
-            filtered_indices[batch_idx][channel_idx] = locs
-
-    return torch.tensor(filtered_indices)
+    return peaks_to_coords(scores, indices, scale, return_scores)
 
 
 def coords_to_dict(coords, threshold=0.05, ground_plane_only=False):
+    # the scores are thresholded for every point at once and the values are read from the CPU once
+    coords = coords.detach().cpu().numpy()
+    n_points = coords.shape[2]
+
+    found = (coords[:, :, :, -1] > threshold).all(axis=2)
+    if ground_plane_only:
+        off_plane = [12, 15, 16, 19] if n_points == 1 else [7, 8, 9, 10, 11, 12]
+        found[:, np.array(off_plane) - 1] = False
+
+    values = coords.tolist()
+
     kp_list = []
-    for batch in range(coords.size()[0]):
+    for batch in range(coords.shape[0]):
         keypoints = {}
-        for count, c in enumerate(range(coords.size(1))):
-            if coords.size(2) == 1:
-                if ground_plane_only and c+1 in [12, 15, 16, 19]:
-                    continue
-                if coords[batch, c, 0, -1] > threshold:
-                    keypoints[count+1] = {'x': coords[batch, c, 0, 0].item(),
-                                          'y': coords[batch, c, 0, 1].item(),
-                                          'p': coords[batch, c, 0, 2].item()}
+        for c in np.flatnonzero(found[batch]).tolist():
+            points = values[batch][c]
+            if n_points == 1:
+                keypoints[c+1] = {'x': points[0][0],
+                                  'y': points[0][1],
+                                  'p': points[0][2]}
             else:
-                if ground_plane_only and c+1 in [7, 8, 9, 10, 11, 12]:
-                    continue
-                if coords[batch, c, 0, -1] > threshold and coords[batch, c, 1, -1] > threshold:
-                    keypoints[count+1] = {'x_1': coords[batch, c, 0, 0].item(),
-                                          'y_1': coords[batch, c, 0, 1].item(),
-                                          'p_1': coords[batch, c, 0, 2].item(),
-                                          'x_2': coords[batch, c, 1, 0].item(),
-                                          'y_2': coords[batch, c, 1, 1].item(),
-                                          'p_2': coords[batch, c, 1, 2].item()}
+                keypoints[c+1] = {'x_1': points[0][0],
+                                  'y_1': points[0][1],
+                                  'p_1': points[0][2],
+                                  'x_2': points[1][0],
+                                  'y_2': points[1][1],
+                                  'p_2': points[1][2]}
 
         kp_list.append(keypoints)
     return kp_list
 
 
-def complete_keypoints(kp_dict, lines_dict, w, h, normalize=False):
-    def line_intersection(x1, y1, x2, y2):
+LINES_LIST = ["Big rect. left bottom", "Big rect. left main", "Big rect. left top", "Big rect. right bottom",
+              "Big rect. right main", "Big rect. right top", "Goal left crossbar", "Goal left post left ",
+              "Goal left post right", "Goal right crossbar", "Goal right post left", "Goal right post right",
+              "Middle line", "Side line bottom", "Side line left", "Side line right", "Side line top",
+              "Small rect. left bottom", "Small rect. left main", "Small rect. left top", "Small rect. right bottom",
+              "Small rect. right main", "Small rect. right top"]
+
+# the lines intersecting at keypoints 1 to 30
+KEYPOINT_LINE_LIST = [['Side line top', 'Side line left'], ['Side line top', 'Middle line'],
+                      ['Side line right', 'Side line top'], ['Side line left', 'Big rect. left top'],
+                      ['Big rect. left top', 'Big rect. left main'], ['Big rect. right top', 'Big rect. right main'],
+                      ['Side line right', 'Big rect. right top'], ['Side line left', 'Small rect. left top'],
+                      ['Small rect. left top', 'Small rect. left main'], ['Small rect. right top', 'Small rect. right main'],
+                      ['Side line right', 'Small rect. right top'], ['Goal left crossbar', 'Goal left post right'],
+                      ['Side line left', 'Goal left post right'], ['Side line right', 'Goal right post left'],
+                      ['Goal right crossbar', 'Goal right post left'], ['Goal left crossbar', 'Goal left post left '],
+                      ['Side line left', 'Goal left post left '], ['Side line right', 'Goal right post right'],
+                      ['Goal right crossbar', 'Goal right post right'], ['Side line left', 'Small rect. left bottom'],
+                      ['Small rect. left bottom', 'Small rect. left main'], ['Small rect. right bottom', 'Small rect. right main'],
+                      ['Side line right', 'Small rect. right bottom'], ['Side line left', 'Big rect. left bottom'],
+                      ['Big rect. left bottom', 'Big rect. left main'], ['Big rect. right main', 'Big rect. right bottom'],
+                      ['Side line right', 'Big rect. right bottom'], ['Side line left', 'Side line bottom'],
+                      ['Side line bottom', 'Middle line'], ['Side line bottom', 'Side line right']]
+
+# the lines intersecting at the auxiliary keypoints 58 and above
+KEYPOINT_AUX_PAIR_LIST = [['Small rect. left main', 'Side line top'], ['Big rect. left main', 'Side line top'],
+                          ['Big rect. right main', 'Side line top'], ['Small rect. right main', 'Side line top'],
+                          ['Small rect. left main', 'Big rect. left top'], ['Big rect. right top', 'Small rect. right main'],
+                          ['Small rect. left top', 'Big rect. left main'], ['Small rect. right top', 'Big rect. right main'],
+                          ['Small rect. left bottom', 'Big rect. left main'], ['Small rect. right bottom', 'Big rect. right main'],
+                          ['Small rect. left main', 'Big rect. left bottom'], ['Small rect. right main', 'Big rect. right bottom'],
+                          ['Small rect. left main', 'Side line bottom'], ['Big rect. left main', 'Side line bottom'],
+                          ['Big rect. right main', 'Side line bottom'], ['Small rect. right main', 'Side line bottom']]
+
+# keys of the intersections and the indices of their lines in LINES_LIST,
+# only the first 15 auxiliary pairs are used, as keys 58 to 72
+INTERSECTION_KEYS = np.array(
+    list(range(1, 31)) + list(range(58, 58 + len(KEYPOINT_AUX_PAIR_LIST) - 1)))
+INTERSECTION_LINES = np.array([
+    [LINES_LIST.index(line) for line in pair]
+    for pair in KEYPOINT_LINE_LIST + KEYPOINT_AUX_PAIR_LIST[:-1]
+])
+
+
+def line_intersections(x1, y1, x2, y2):
+    """
+    Returns the intersections of the lines through the pairs of points (x1, y1) and (x2, y2),
+    given as Nx2 arrays. The slopes and intercepts are the least squares fits of linregress,
+    computed in closed form for all the pairs at once.
+    """
+    def fit(x, y):
         # 1e-7 sum in case there are two identical coordinate values
-        x1[-1] += 1e-7
-        x2[-1] += 1e-7
-        slope1, intercept1, r1, p1, se1 = linregress(x1, y1)
-        slope2, intercept2, r2, p2, se2 = linregress(x2, y2)
+        x = x.copy()
+        x[:, -1] += 1e-7
+
+        dx = x - (x[:, 0] + x[:, 1])[:, None] / 2
+        dy = y - (y[:, 0] + y[:, 1])[:, None] / 2
+        ssxm = (dx[:, 0] * dx[:, 0] + dx[:, 1] * dx[:, 1]) * 0.5
+        ssxym = (dx[:, 0] * dy[:, 0] + dx[:, 1] * dy[:, 1]) * 0.5
+
+        slope = ssxym / ssxm
+        intercept = (y[:, 0] + y[:, 1]) / 2 - slope * (x[:, 0] + x[:, 1]) / 2
+        return slope, intercept
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope1, intercept1 = fit(x1, y1)
+        slope2, intercept2 = fit(x2, y2)
 
         x_intersection = (intercept2 - intercept1) / (slope1 - slope2 + 1e-7)
         y_intersection = slope1 * x_intersection + intercept1
 
-        return x_intersection, y_intersection
-
-    lines_list = ["Big rect. left bottom", "Big rect. left main", "Big rect. left top", "Big rect. right bottom",
-                  "Big rect. right main", "Big rect. right top", "Goal left crossbar", "Goal left post left ",
-                  "Goal left post right", "Goal right crossbar", "Goal right post left", "Goal right post right",
-                  "Middle line", "Side line bottom", "Side line left", "Side line right", "Side line top",
-                  "Small rect. left bottom", "Small rect. left main", "Small rect. left top", "Small rect. right bottom",
-                  "Small rect. right main", "Small rect. right top"]
-
-    keypoints_line_list = [['Side line top', 'Side line left'], ['Side line top', 'Middle line'],
-                           ['Side line right', 'Side line top'], [
-                               'Side line left', 'Big rect. left top'],
-                           ['Big rect. left top', 'Big rect. left main'], [
-                               'Big rect. right top', 'Big rect. right main'],
-                           ['Side line right', 'Big rect. right top'], [
-                               'Side line left', 'Small rect. left top'],
-                           ['Small rect. left top', 'Small rect. left main'], [
-                               'Small rect. right top', 'Small rect. right main'],
-                           ['Side line right', 'Small rect. right top'], [
-                               'Goal left crossbar', 'Goal left post right'],
-                           ['Side line left', 'Goal left post right'], [
-                               'Side line right', 'Goal right post left'],
-                           ['Goal right crossbar', 'Goal right post left'], [
-                               'Goal left crossbar', 'Goal left post left '],
-                           ['Side line left', 'Goal left post left '], [
-                               'Side line right', 'Goal right post right'],
-                           ['Goal right crossbar', 'Goal right post right'], [
-                               'Side line left', 'Small rect. left bottom'],
-                           ['Small rect. left bottom', 'Small rect. left main'], [
-                               'Small rect. right bottom', 'Small rect. right main'],
-                           ['Side line right', 'Small rect. right bottom'], [
-                               'Side line left', 'Big rect. left bottom'],
-                           ['Big rect. left bottom', 'Big rect. left main'], [
-                               'Big rect. right main', 'Big rect. right bottom'],
-                           ['Side line right', 'Big rect. right bottom'], [
-                               'Side line left', 'Side line bottom'],
-                           ['Side line bottom', 'Middle line'], ['Side line bottom', 'Side line right']]
-
-    keypoint_aux_pair_list = [['Small rect. left main', 'Side line top'], ['Big rect. left main', 'Side line top'],
-                              ['Big rect. right main', 'Side line top'], [
-                                  'Small rect. right main', 'Side line top'],
-                              ['Small rect. left main', 'Big rect. left top'], [
-                                  'Big rect. right top', 'Small rect. right main'],
-                              ['Small rect. left top', 'Big rect. left main'], [
-                                  'Small rect. right top', 'Big rect. right main'],
-                              ['Small rect. left bottom', 'Big rect. left main'], [
-                                  'Small rect. right bottom', 'Big rect. right main'],
-                              ['Small rect. left main', 'Big rect. left bottom'], [
-                                  'Small rect. right main', 'Big rect. right bottom'],
-                              ['Small rect. left main', 'Side line bottom'], [
-                                  'Big rect. left main', 'Side line bottom'],
-                              ['Big rect. right main', 'Side line bottom'], ['Small rect. right main', 'Side line bottom']]
+    return x_intersection, y_intersection
 
+
+def complete_keypoints(kp_dict, lines_dict, w, h, normalize=False):
     w_extra = 0.5 * w
     h_extra = 0.5 * h
 
     complete_list = []
     for batch in range(len(kp_dict)):
-        complete_dict = copy.deepcopy(kp_dict[batch])
-        for key in range(1, 31):
-            if key not in kp_dict[batch].keys():
-                line_keys = keypoints_line_list[key-1]
-                line_key1, line_key2 = lines_list.index(
-                    line_keys[0]) + 1, lines_list.index(line_keys[1]) + 1
-                if all(line_key in lines_dict[batch].keys() for line_key in [line_key1, line_key2]):
-                    x1 = [lines_dict[batch][line_key1]['x_1'],
-                          lines_dict[batch][line_key1]['x_2']]
-                    y1 = [lines_dict[batch][line_key1]['y_1'],
-                          lines_dict[batch][line_key1]['y_2']]
-                    x2 = [lines_dict[batch][line_key2]['x_1'],
-                          lines_dict[batch][line_key2]['x_2']]
-                    y2 = [lines_dict[batch][line_key2]['y_1'],
-                          lines_dict[batch][line_key2]['y_2']]
-                    new_kp = line_intersection(x1, y1, x2, y2)
-                    if -w_extra < new_kp[0] < w_extra + w and -h_extra < new_kp[1] < h_extra + h:
-                        complete_dict[key] = {'x': round(
-                            new_kp[0], 0), 'y': round(new_kp[1], 0), 'p': 1.}
-
-        for key in range(1, len(keypoint_aux_pair_list)):
-            line_keys = keypoint_aux_pair_list[key-1]
-            line_key1, line_key2 = lines_list.index(
-                line_keys[0]) + 1, lines_list.index(line_keys[1]) + 1
-            if all(line_key in lines_dict[batch].keys() for line_key in [line_key1, line_key2]):
-                x1 = [lines_dict[batch][line_key1]['x_1'],
-                      lines_dict[batch][line_key1]['x_2']]
-                y1 = [lines_dict[batch][line_key1]['y_1'],
-                      lines_dict[batch][line_key1]['y_2']]
-                x2 = [lines_dict[batch][line_key2]['x_1'],
-                      lines_dict[batch][line_key2]['x_2']]
-                y2 = [lines_dict[batch][line_key2]['y_1'],
-                      lines_dict[batch][line_key2]['y_2']]
-                new_kp = line_intersection(x1, y1, x2, y2)
-                if -w_extra < new_kp[0] < w_extra + w and -h_extra < new_kp[1] < h_extra + h:
-                    complete_dict[key+57] = {'x': round(
-                        new_kp[0], 0), 'y': round(new_kp[1], 0), 'p': 1.}
+        # endpoints of every line, nan for the lines that were not found
+        lines = np.full((len(LINES_LIST), 4), np.nan)
+        for line_key, line in lines_dict[batch].items():
+            lines[line_key - 1] = [line['x_1'], line['x_2'], line['y_1'], line['y_2']]
+
+        first = lines[INTERSECTION_LINES[:, 0]]
+        second = lines[INTERSECTION_LINES[:, 1]]
+        x, y = line_intersections(first[:, :2], first[:, 2:], second[:, :2], second[:, 2:])
+
+        # the comparisons are False for the intersections of missing lines
+        with np.errstate(invalid='ignore'):
+            inside = (-w_extra < x) & (x < w_extra + w) & (-h_extra < y) & (y < h_extra + h)
+        x, y = np.round(x, 0), np.round(y, 0)
+
+        complete_dict = {key: dict(values) for key, values in kp_dict[batch].items()}
+        for i in np.flatnonzero(inside):
+            key = int(INTERSECTION_KEYS[i])
+            # detected keypoints are kept over the intersections
+            if key <= 30 and key in kp_dict[batch]:
+                continue
+            complete_dict[key] = {'x': x[i], 'y': y[i], 'p': 1.}
 
         if normalize:
             for kp in complete_dict.keys():
@@ -1,24 +1,30 @@
 import os
 import sys
+import cv2
+import time
 import yaml
 import numpy as np
-from PIL import Image
 
 import torch
-import torchvision.transforms as T
-import torchvision.transforms.functional as f
 
 cdir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(cdir)
 from hrnet import get_cls_net
-from calib import FramebyFrameCalib
+from calib import FramebyFrameCalib, pan_tilt_roll_to_orientation
 from hrnet_l import get_cls_net as get_cls_net_l
+from backend import default_device, load_exported
 from heatmap import get_keypoints_from_heatmap_batch_maxpool, \
     get_keypoints_from_heatmap_batch_maxpool_l, \
     complete_keypoints, coords_to_dict
 
 
-DEVICE = torch.device('cuda')
+DEVICE = torch.device(default_device())
+
+WEIGHTS_KP = f'{cdir}/../../models/SV_FT_WC14_kp'
+WEIGHTS_LINE = f'{cdir}/../../models/SV_FT_WC14_lines'
+
+# height and width of the frames the keypoint and line models take
+INPUT_SIZE = (540, 960)
 
 
 def projection_from_cam_params(final_params_dict):
@@ -50,27 +56,67 @@ def projection_from_cam_params(final_params_dict):
     return P
 
 
-def inference(cam, frame, model, model_l, kp_threshold, line_threshold, device=DEVICE):
+def frame_tensor(frame, out=None):
     """
-    Inference function for the model. It takes a frame and returns the camera parameters.
+    Converts the frame to the 1x3x540x960 input of the keypoint and line models.
+
+    The uint8 frame is resized first, then shared with torch without a copy and written
+    to the input with the scaling to [0, 1] in a single pass. If out is given, the input is
+    written to it instead of a new tensor, so the same buffer can be reused for every frame.
     """
-    frame = Image.fromarray(frame)
-    frame = f.to_tensor(frame).float().unsqueeze(0)
-    frame = frame if frame.size()[-1] == 960 else T.Resize((540, 960))(frame)
+    height, width = INPUT_SIZE
+    if frame.shape[:2] != INPUT_SIZE:
+        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
 
-    frame = frame.to(device)
-    _, _, h, w = frame.size()
+    if out is None:
+        out = torch.empty((1, 3, height, width))
 
-    # Perform keypoint and line detection
-    model.eval()
-    model.to(device)
+    torch.div(torch.from_numpy(frame).permute(2, 0, 1), 255., out=out[0])
 
-    model_l.eval()
-    model_l.to(device)
+    return out
+
+
+def frames_tensor(frames, buffer=None):
+    """
+    Converts the frames to the Nx3x540x960 input of the keypoint and line models.
+
+    The inputs are written to the first frames of the buffer if it is large enough.
+    """
+    if buffer is None or len(buffer) < len(frames):
+        buffer = torch.empty((len(frames), 3, *INPUT_SIZE))
+
+    for i, frame in enumerate(frames):
+        frame_tensor(frame, out=buffer[i:i + 1])
+
+    return buffer[:len(frames)]
+
+
+def detect_keypoints(frame, model, model_l, kp_threshold, line_threshold, device=DEVICE):
+    """
+    Detects the pitch keypoints in the frame, including the ones found by intersecting the lines.
+
+    The keypoints are normalized by the frame size.
+    """
+    return detect_keypoints_batch(
+        [frame], model, model_l, kp_threshold, line_threshold, device=device
+    )[0]
+
+
+def detect_keypoints_batch(frames, model, model_l, kp_threshold, line_threshold, device=DEVICE, buffer=None):
+    """
+    Detects the pitch keypoints in each frame of a batch, running each model once on the whole batch.
 
+    Returns the normalized keypoints of each frame in the same order as the frames.
+    The inputs are written to buffer if it is large enough, see frames_tensor.
+    """
+    frames = frames_tensor(frames, buffer).to(device)
+    _, _, h, w = frames.size()
+
+    # Perform keypoint and line detection
+    # the models are expected to be on the device and in eval mode already
     with torch.no_grad():
-        heatmaps = model(frame)
-        heatmaps_l = model_l(frame)
+        heatmaps = model(frames)
+        heatmaps_l = model_l(frames)
 
     kp_coords = get_keypoints_from_heatmap_batch_maxpool(
         heatmaps[:, :-1, :, :],
@@ -95,78 +141,303 @@ def inference(cam, frame, model, model_l, kp_threshold, line_threshold, device=D
         normalize=True,
     )
 
-    cam.update(final_dict[0])
+    return final_dict
+
+
+def inference(cam, frame, model, model_l, kp_threshold, line_threshold, device=DEVICE):
+    """
+    Inference function for the model. It takes a frame and returns the camera parameters.
+    """
+    keypoints = detect_keypoints(
+        frame, model, model_l, kp_threshold, line_threshold, device=device
+    )
+
+    cam.update(keypoints)
     final_params_dict = cam.heuristic_voting()
 
     return final_params_dict
 
 
-def get_map_point(point, P):
+def get_map_points(points, P_inv):
     """
-    Get the map point from the point and the projection matrix.
+    Get the map points from an Nx3 array of homogeneous points and the inverse of the projection matrix.
+
+    P_inv can also be an Nx3x3 array with a matrix for each point.
     """
-    point = np.linalg.inv(P) @ np.array(point)
-    point = point/point[2]
-    point[0] += 105 / 2
-    point[1] += 68 / 2
+    if P_inv.ndim == 3:
+        points = np.einsum('nij,nj->ni', P_inv, points)
+    else:
+        points = points @ P_inv.T
+
+    points = points[:, :2] / points[:, 2:]
+    points = points + [105 / 2, 68 / 2]
 
-    return (point[0]/105, point[1]/68)
+    return points / [105, 68]
+
+
+def image_points(coords, h, w):
+    """
+    Returns the bottom center of the boxes followed by the four corners of the frame as homogeneous points.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 4)
+    anchors = np.column_stack([
+        (coords[:, 0] + coords[:, 2]) / 2,
+        coords[:, 3],
+        np.ones(len(coords)),
+    ])
+    corners = np.array([[0, 0, 1], [0, h, 1], [w, h, 1], [w, 0, 1]], dtype=float)
+
+    return np.vstack([anchors, corners])
 
 
 def project(P, coords, h, w):
     """
     Return projected points and edges for the 2D map.
+
+    The matrix is inverted once and all the points are projected together.
     """
-    pts = [get_map_point([(x1 + x2) / 2, y2, 1], P)
-           for x1, _, x2, y2 in coords]
+    points = get_map_points(image_points(coords, h, w), np.linalg.inv(P))
 
-    edges = [(0, 0, 1), (0, h, 1), (w, h, 1), (w, 0, 1)]
-    edges = [get_map_point(edge, P) for edge in edges]
+    return points[:-4], points[-4:]
 
-    return pts, edges
 
+def project_batch(Ps, coords_list, h, w):
+    """
+    Return projected points and edges for the 2D map for a chunk of frames.
 
-def process_input(input, coords, model, model_l, kp_threshold, line_threshold):
+    Ps holds the projection matrix of each frame, or None where the calibration failed.
     """
-    Takes 3D map coordinates, poses and labels and returns the 2D map points and edges.
+    valid = [i for i, P in enumerate(Ps) if P is not None]
+    results = [([], [])] * len(Ps)
+    if not valid:
+        return results
+
+    P_inv = np.linalg.inv(np.stack([Ps[i] for i in valid]))
+    points = [image_points(coords_list[i], h, w) for i in valid]
+    sizes = [len(p) for p in points]
+
+    # every point is mapped with the inverse of its own frame
+    index = np.repeat(np.arange(len(valid)), sizes)
+    points = get_map_points(np.vstack(points), P_inv[index])
+
+    for i, frame_points in zip(valid, np.split(points, np.cumsum(sizes)[:-1])):
+        results[i] = (frame_points[:-4], frame_points[-4:])
+
+    return results
+
+
+def oriented(P, h, w):
     """
-    frame_height = input.shape[0]
-    frame_width = input.shape[1]
+    Returns P scaled so the points in front of the camera have a positive scale.
 
-    cam = FramebyFrameCalib(
-        iwidth=frame_width, iheight=frame_height, denormalize=True
-    )
+    The sign of a homography is arbitrary, the center of the frame is taken to be on the ground in front of the camera.
+    """
+    P = np.asarray(P, dtype=float)
+    center = np.linalg.inv(P) @ [w / 2, h / 2, 1]
 
-    final_params_dict = inference(
-        cam, input, model, model_l, kp_threshold, line_threshold
-    )
+    return P if center[2] > 0 else -P
 
-    if final_params_dict is not None:
-        P = projection_from_cam_params(final_params_dict)
 
-        P_reduced = np.array([
-            [P[0][0], P[0][1], P[0][3]],
-            [P[1][0], P[1][1], P[1][3]],
-            [P[2][0], P[2][1], P[2][3]],
-        ])
-        pts, edges = project(P_reduced, coords, frame_height, frame_width)
+def pitch_polygon(P, h, w, margin=3., eps=1e-6):
+    """
+    Returns the outline of the pitch in the image, extended by margin meters on every side.
 
-    else:
-        pts, edges = [], []
+    This is the inverse of the edges returned by project: the corners of the pitch are mapped
+    to the image with P, after cutting the outline where it goes behind the camera.
+    """
+    x, y = 105 / 2 + margin, 68 / 2 + margin
+    corners = np.array([[-x, -y, 1], [x, -y, 1], [x, y, 1], [-x, y, 1]]) @ oriented(P, h, w).T
 
-    return pts, edges
+    # keep the part of the outline in front of the camera
+    outline = []
+    for a, b in zip(corners, np.roll(corners, -1, axis=0)):
+        if a[2] > eps:
+            outline.append(a)
+        if (a[2] > eps) != (b[2] > eps):
+            t = (eps - a[2]) / (b[2] - a[2])
+            outline.append(a + t * (b - a))
 
+    if len(outline) < 3:
+        return np.zeros((0, 2))
 
-def inf_main(input, coords, kp_threshold=0.1486, line_threshold=0.3880, device=DEVICE):
+    outline = np.array(outline)
+    return outline[:, :2] / outline[:, 2:]
+
+
+def pitch_region(P, h, w, margin=3., pad=32):
     """
-    Main function for inference.
+    Returns the box (x1, y1, x2, y2) of the frame holding the pitch extended by margin meters
+    and pad pixels, or None if the pitch is not in the frame.
+    """
+    outline = pitch_polygon(P, h, w, margin)
+    if len(outline) == 0:
+        return None
+
+    x1, y1 = np.floor(outline.min(axis=0)) - pad
+    x2, y2 = np.ceil(outline.max(axis=0)) + pad
+    x1, y1 = int(max(x1, 0)), int(max(y1, 0))
+    x2, y2 = int(min(x2, w)), int(min(y2, h))
+    if x2 <= x1 or y2 <= y1:
+        return None
+
+    return x1, y1, x2, y2
+
+
+def on_pitch(P, coords, h, w, margin=3.):
+    """
+    Returns which boxes stand on the pitch extended by margin meters, from the bottom center of the boxes.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 4)
+    anchors = np.column_stack([
+        (coords[:, 0] + coords[:, 2]) / 2,
+        coords[:, 3],
+        np.ones(len(coords)),
+    ]) @ np.linalg.inv(oriented(P, h, w)).T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        points = anchors[:, :2] / anchors[:, 2:]
+        inside = (np.abs(points) <= [105 / 2 + margin, 68 / 2 + margin]).all(axis=1)
+
+    # points above the horizon are behind the camera and have a negative scale
+    return inside & (anchors[:, 2] > 0)
+
+
+class PitchFilter:
+    """
+    Keeps the detection to the part of the frame showing the pitch, found with the last calibration.
+
+    The detection models only see the box of the frame holding the pitch, extended by margin
+    meters and pad pixels so the players near the lines and the camera motion since the last
+    calibration are covered, and the boxes standing off the pitch are dropped before tracking.
+    Until a frame is calibrated the whole frame is used.
+    """
+
+    def __init__(self, margin=3., pad=32):
+        self.margin = margin
+        self.pad = pad
+        self.region = None
+
+        self.pixels = 0
+        self.frame_pixels = 0
+        self.kept = 0
+        self.dropped = 0
+
+    def update(self, P, size):
+        """
+        Updates the region with the projection matrix of a frame of the given size.
+        """
+        self.region = None if P is None else pitch_region(P, *size, self.margin, self.pad)
+
+    def reset(self):
+        """
+        Uses the whole frame again, after a cut the last calibration is not valid anymore.
+        """
+        self.region = None
+
+    def crop(self, frame, region):
+        """
+        Returns the part of the frame in region and its top left corner.
+        """
+        h, w = frame.shape[:2]
+        self.frame_pixels += h * w
+        if region is None:
+            self.pixels += h * w
+            return frame, (0, 0)
+
+        x1, y1, x2, y2 = region
+        self.pixels += (x2 - x1) * (y2 - y1)
+        return frame[y1:y2, x1:x2], (x1, y1)
+
+    def filter(self, P, detections, size):
+        """
+        Drops the detections standing off the pitch in a frame of the given size, or keeps them all if P is None.
+        """
+        if P is None or len(detections) == 0:
+            self.kept += len(detections)
+            return detections
+
+        inside = on_pitch(P, detections.xyxy, *size, self.margin)
+        self.kept += int(inside.sum())
+        self.dropped += int((~inside).sum())
+
+        return detections[inside]
+
+    def report(self):
+        """
+        Returns the fraction of the pixels the models ran on and the number of boxes dropped.
+        """
+        rate = self.pixels / self.frame_pixels if self.frame_pixels else 1.
+        boxes = self.kept + self.dropped
+
+        return (
+            f'Pitch filter: models ran on {rate:.0%} of the pixels, '
+            f'{self.dropped} of {boxes} player boxes dropped off the pitch'
+        )
+
+
+def smooth_cam_params(cam_params, previous, alpha=0.5, max_jump=10.):
+    """
+    Blends the pan, tilt, roll and focal length of the camera with the previous frame.
+
+    alpha is the weight of the current frame. Angles that changed by more than
+    max_jump degrees are taken as they are since the camera has probably cut.
+    """
+    def blend(current, last):
+        # wrap the difference so that 179 and -179 degrees are close
+        diff = (current - last + 180) % 360 - 180
+        if abs(diff) > max_jump:
+            return current
+        return last + alpha * diff
+
+    pan = blend(cam_params['pan_degrees'], previous['pan_degrees'])
+    tilt = blend(cam_params['tilt_degrees'], previous['tilt_degrees'])
+    roll = blend(cam_params['roll_degrees'], previous['roll_degrees'])
+
+    focal_length = cam_params['x_focal_length']
+    last_focal_length = previous['x_focal_length']
+    if abs(focal_length - last_focal_length) <= max_jump / 100 * last_focal_length:
+        focal_length = last_focal_length + alpha * (focal_length - last_focal_length)
+
+    orientation = pan_tilt_roll_to_orientation(
+        np.deg2rad(pan), np.deg2rad(tilt), np.deg2rad(roll))
+
+    smoothed = dict(cam_params)
+    smoothed.update({
+        'pan_degrees': pan,
+        'tilt_degrees': tilt,
+        'roll_degrees': roll,
+        'x_focal_length': focal_length,
+        'y_focal_length': focal_length,
+        'rotation_matrix': np.transpose(orientation).tolist(),
+    })
+
+    return smoothed
+
+
+def reduce_projection(P):
+    """
+    Drops the z column of the projection matrix to get the
+    homography between the ground plane and the image.
+    """
+    return np.array([
+        [P[0][0], P[0][1], P[0][3]],
+        [P[1][0], P[1][1], P[1][3]],
+        [P[2][0], P[2][1], P[2][3]],
+    ])
+
+
+def load_models(device=DEVICE, backend='torch', threads=None, quantized=False):
+    """
+    Loads the keypoint and line models from the models folder.
+
+    With the 'onnx' or 'openvino' backend, the models are exported once and run on the CPU
+    with threads threads. If quantized is True, the INT8 graphs built by quantize.py are used.
     """
     cfg = yaml.safe_load(open(f'{cdir}/../config/hrnetv2_w48.yaml', 'r'))
     cfg_l = yaml.safe_load(open(f'{cdir}/../config/hrnetv2_w48_l.yaml', 'r'))
 
-    # Load models
-    weights_kp = f'{cdir}/../../models/SV_FT_WC14_kp'
-    weights_line = f'{cdir}/../../models/SV_FT_WC14_lines'
+    weights_kp = WEIGHTS_KP
+    weights_line = WEIGHTS_LINE
 
     loaded_state = torch.load(weights_kp, map_location=device)
     model = get_cls_net(cfg)
@@ -180,14 +451,204 @@ def inf_main(input, coords, kp_threshold=0.1486, line_threshold=0.3880, device=D
     model_l.to(device)
     model_l.eval()
 
-    # Process input
-    pts, edges = process_input(
-        input,
-        coords,
-        model,
-        model_l,
-        kp_threshold,
-        line_threshold,
+    model = load_exported(
+        model, weights_kp, backend, threads=threads, quantized=quantized)
+    model_l = load_exported(
+        model_l, weights_line, backend, threads=threads, quantized=quantized)
+
+    return model, model_l
+
+
+class CalibrationEngine:
+    """
+    Calibrates the camera frame by frame while keeping the keypoint and
+    line models loaded for the whole run.
+
+    calibrate is called once per frame and project uses the result of
+    the last calibration to map the detections to the 2D plane.
+
+    In the 'full' mode the camera parameters are found by voting between the
+    calibration modes and RANSAC thresholds. In the 'fast' mode a single RANSAC
+    homography of the ground plane is used, falling back to the voting only
+    when its reprojection error is above max_rep_err pixels. In the 'temporal'
+    mode the solver starts from the previous frame's camera, the mode that won
+    the previous voting is tried first, and the camera angles and focal length
+    are smoothed over time with weight smoothing for the current frame.
+
+    backend picks how the models run, 'torch' on the device or an exported
+    'onnx' or 'openvino' graph on the CPU with threads threads, using the
+    INT8 graphs if quantized is True.
+    """
+
+    def __init__(self, kp_threshold=0.1486, line_threshold=0.3880, mode='full', max_rep_err=10., smoothing=0.5, device=DEVICE, backend='torch', threads=None, quantized=False):
+        if mode not in ['full', 'fast', 'temporal']:
+            raise ValueError(f'Unknown calibration mode {mode}')
+
+        self.kp_threshold = kp_threshold
+        self.line_threshold = line_threshold
+        self.mode = mode
+        self.max_rep_err = max_rep_err
+        self.smoothing = smoothing
+        self.backend = backend
+        self.threads = threads
+        self.quantized = quantized
+        # the exported models take their inputs on the CPU
+        self.device = device if backend == 'torch' else torch.device('cpu')
+
+        start = time.perf_counter()
+        self.model, self.model_l = load_models(
+            self.device, backend, threads, quantized)
+        self.load_time = time.perf_counter() - start
+
+        # input of the models, reused between batches and grown for larger ones
+        self.buffer = None
+
+        self.cam = None
+        self.size = None
+        self.P = None
+        self.params = None
+        self.frame_times = []
+        self.fit_times = []
+        self.fallbacks = 0
+
+    def __getstate__(self):
+        # the models are loaded again instead of being saved with the state
+        state = self.__dict__.copy()
+        del state['model'], state['model_l']
+        state['buffer'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.model, self.model_l = load_models(
+            self.device, self.backend, self.threads, self.quantized)
+
+    def calibrate(self, frame):
+        """
+        Calibrates the camera using the frame.
+
+        Returns the ground plane projection matrix, or None if the calibration failed.
+        """
+        return self.calibrate_batch([frame])[0]
+
+    def calibrate_batch(self, frames):
+        """
+        Calibrates the camera on each frame of a batch, in order.
+
+        The keypoint and line models run once on the whole batch, then the camera
+        is solved frame by frame, so the temporal mode still follows the frames.
+        Returns the projection matrix of each frame, None where the calibration failed.
+        """
+        start = time.perf_counter()
+
+        if self.buffer is None or len(self.buffer) < len(frames):
+            self.buffer = torch.empty((len(frames), 3, *INPUT_SIZE))
+
+        keypoints = detect_keypoints_batch(
+            frames,
+            self.model,
+            self.model_l,
+            self.kp_threshold,
+            self.line_threshold,
+            device=self.device,
+            buffer=self.buffer,
+        )
+        # the time of the models is shared between the frames of the batch
+        model_time = (time.perf_counter() - start) / len(frames)
+
+        projections = []
+        for frame, frame_keypoints in zip(frames, keypoints):
+            size = frame.shape[:2]
+            if self.cam is None or self.size != size:
+                self.cam = FramebyFrameCalib(
+                    iwidth=size[1], iheight=size[0], denormalize=True
+                )
+                self.size = size
+            self.cam.update(frame_keypoints)
+
+            fit_start = time.perf_counter()
+            self.P = self.fit()
+            self.fit_times.append(time.perf_counter() - fit_start)
+            self.frame_times.append(model_time + self.fit_times[-1])
+
+            projections.append(self.P)
+
+        return projections
+
+    def fit(self):
+        """
+        Returns the ground plane projection matrix for the keypoints of the current frame.
+        """
+        if self.mode == 'fast':
+            H, rep_err = self.cam.get_homography_with_error()
+            if H is not None and rep_err <= self.max_rep_err:
+                self.params = None
+                return H
+            self.fallbacks += 1
+
+        if self.mode == 'temporal':
+            final_params_dict = self.cam.temporal_voting(
+                self.params, max_rep_err=self.max_rep_err)
+            if final_params_dict is not None and self.params is not None:
+                final_params_dict['cam_params'] = smooth_cam_params(
+                    final_params_dict['cam_params'],
+                    self.params['cam_params'],
+                    alpha=self.smoothing,
+                )
+        else:
+            final_params_dict = self.cam.heuristic_voting()
+
+        self.params = final_params_dict
+        if final_params_dict is None:
+            return None
+
+        P = projection_from_cam_params(final_params_dict)
+        return reduce_projection(P)
+
+    def project(self, coords):
+        """
+        Projects the coordinates using the last calibration.
+
+        Returns empty points and edges if the last calibration failed.
+        """
+        if self.P is None:
+            return [], []
+
+        frame_height, frame_width = self.size
+        return project(self.P, coords, frame_height, frame_width)
+
+    def report(self):
+        """
+        Returns the model load time and the per frame calibration time.
+        """
+        frames = len(self.frame_times)
+        per_frame = sum(self.frame_times) / frames if frames else 0.
+        per_fit = sum(self.fit_times) / frames if frames else 0.
+
+        report = (
+            f'Calibration: models loaded in {self.load_time:.2f}s, '
+            f'{frames} frames at {per_frame * 1000:.1f}ms per frame '
+            f'({per_fit * 1000:.1f}ms solving)'
+        )
+        if self.mode == 'fast':
+            report += f', {self.fallbacks} fallbacks to voting'
+
+        return report
+
+
+def inf_main(input, coords, kp_threshold=0.1486, line_threshold=0.3880, mode='full', device=DEVICE):
+    """
+    Main function for inference.
+
+    Loads the models for a single frame, use CalibrationEngine for videos.
+    """
+    engine = CalibrationEngine(
+        kp_threshold=kp_threshold,
+        line_threshold=line_threshold,
+        mode=mode,
+        device=device,
     )
+    engine.calibrate(input)
+    pts, edges = engine.project(coords)
 
     return pts, edges
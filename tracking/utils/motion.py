@@ -0,0 +1,247 @@
+import cv2
+import numpy as np
+
+
+def pitch_mask(frame):
+    """
+    Returns a mask of the green pixels of the frame.
+    """
+    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    mask = cv2.inRange(hsv, (35, 40, 40), (85, 255, 255))
+
+    # erode to stay away from the lines and the players on the pitch
+    return cv2.erode(mask, np.ones((5, 5), np.uint8))
+
+
+def frame_histogram(frame):
+    """
+    Returns the normalized hue and saturation histogram of the frame.
+    """
+    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1], None, [30, 32], [0, 180, 0, 256])
+
+    return cv2.normalize(hist, hist).flatten()
+
+
+class MotionGatedCalibration:
+    """
+    Runs the full calibration only on keyframes and follows the camera with
+    optical flow in between.
+
+    A frame is a keyframe after a scene cut, a large camera motion, every
+    key_interval frames or when the drift since the last keyframe exceeds max_drift.
+    Between keyframes, points on the pitch are tracked with sparse optical flow and
+    the frame to frame homography is applied to the last projection matrix.
+    """
+
+    def __init__(self, engine, key_interval=25, max_drift=5., max_motion=20., cut_threshold=0.7, scale=0.5, min_points=20):
+        """
+        engine is the CalibrationEngine used on the keyframes.
+        max_drift is the total reprojection error of the optical flow in pixels allowed since the last keyframe.
+        max_motion is the median motion of the pitch points in pixels above which the frame is recalibrated.
+        cut_threshold is the histogram correlation with the previous frame below which the frame is a scene cut.
+        The optical flow is computed on frames resized by scale.
+        """
+        self.engine = engine
+        self.key_interval = key_interval
+        self.max_drift = max_drift
+        self.max_motion = max_motion
+        self.cut_threshold = cut_threshold
+        self.scale = scale
+        self.min_points = min_points
+
+        self.prev_gray = None
+        self.prev_hist = None
+        self.prev_mask = None
+        self.since_key = 0
+        self.drift = 0.
+
+        self.full = 0
+        self.propagated = 0
+
+    @property
+    def P(self):
+        return self.engine.P
+
+    def update(self, small, gray, hist):
+        """
+        Keeps the resized frame for the optical flow of the next frame.
+        """
+        self.prev_gray = gray
+        self.prev_hist = hist
+        self.prev_mask = pitch_mask(small)
+
+    def keyframe(self, frame, small, gray, hist):
+        """
+        Runs the full calibration on the frame.
+        """
+        self.full += 1
+        self.since_key = 0
+        self.drift = 0.
+        self.update(small, gray, hist)
+
+        return self.engine.calibrate(frame)
+
+    def flow(self, gray):
+        """
+        Returns the homography between the previous frame and the frame,
+        the median motion and the reprojection error in pixels of the full frame.
+        """
+        points = cv2.goodFeaturesToTrack(
+            self.prev_gray, maxCorners=200, qualityLevel=0.01, minDistance=8, mask=self.prev_mask)
+        if points is None or len(points) < self.min_points:
+            return None, None, None
+
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(
+            self.prev_gray, gray, points, None)
+        status = status.ravel() == 1
+        points, next_points = points[status], next_points[status]
+        if len(points) < self.min_points:
+            return None, None, None
+
+        M, inliers = cv2.findHomography(points, next_points, cv2.RANSAC, 3.)
+        if M is None:
+            return None, None, None
+
+        inliers = inliers.ravel() == 1
+        points, next_points = points[inliers], next_points[inliers]
+
+        moved = cv2.perspectiveTransform(points, M)
+        error = np.sqrt(((moved - next_points) ** 2).sum(axis=-1)).mean()
+        motion = np.median(np.linalg.norm(next_points - points, axis=-1))
+
+        # homography of the resized frames to the homography of the full frames
+        S = np.diag([self.scale, self.scale, 1.])
+        M = np.linalg.inv(S) @ M @ S
+
+        return M, motion / self.scale, error / self.scale
+
+    def calibrate(self, frame):
+        """
+        Calibrates the camera using the frame, running the full calibration only if needed.
+
+        Returns the ground plane projection matrix, or None if the calibration failed.
+        """
+        small = cv2.resize(frame, None, fx=self.scale, fy=self.scale)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        hist = frame_histogram(small)
+
+        if self.P is None or self.prev_gray is None or self.since_key + 1 >= self.key_interval:
+            return self.keyframe(frame, small, gray, hist)
+
+        # scene cut
+        if cv2.compareHist(self.prev_hist, hist, cv2.HISTCMP_CORREL) < self.cut_threshold:
+            return self.keyframe(frame, small, gray, hist)
+
+        M, motion, error = self.flow(gray)
+        if M is None or motion > self.max_motion or self.drift + error > self.max_drift:
+            return self.keyframe(frame, small, gray, hist)
+
+        self.engine.P = M @ self.engine.P
+        self.drift += error
+        self.since_key += 1
+        self.propagated += 1
+        self.update(small, gray, hist)
+
+        return self.P
+
+    def project(self, coords):
+        """
+        Projects the coordinates using the last calibration.
+        """
+        return self.engine.project(coords)
+
+    def report(self):
+        """
+        Returns the number of full calibrations and the number that were skipped.
+        """
+        frames = self.full + self.propagated
+        skipped = self.propagated / frames if frames else 0.
+
+        return (
+            f'{self.engine.report()}\n'
+            f'Motion gating: {self.full} full calibrations, '
+            f'{self.propagated} skipped ({skipped:.0%} of frames)'
+        )
+
+
+def propagate_boxes(prev_gray, gray, xyxy, grid=4, margin=0.2):
+    """
+    Moves the boxes from the previous frame to the frame with sparse optical flow.
+
+    A grid of points in the middle of every box is tracked and each box is shifted
+    by the median motion of its points. Boxes whose points are all lost stay in place.
+    """
+    if len(xyxy) == 0:
+        return xyxy
+
+    # points away from the edges of the boxes, where the background is
+    steps = margin + (1 - 2 * margin) * (np.arange(grid) + 0.5) / grid
+    u, v = np.meshgrid(steps, steps)
+    u, v = u.ravel(), v.ravel()
+
+    x1, y1, x2, y2 = xyxy.T
+    xs = x1[:, None] + (x2 - x1)[:, None] * u
+    ys = y1[:, None] + (y2 - y1)[:, None] * v
+    points = np.stack([xs, ys], axis=-1).reshape(-1, 1, 2).astype(np.float32)
+
+    next_points, status, _ = cv2.calcOpticalFlowPyrLK(
+        prev_gray, gray, points, None, winSize=(15, 15), maxLevel=2)
+
+    motion = (next_points - points).reshape(len(xyxy), -1, 2)
+    status = status.reshape(len(xyxy), -1) == 1
+    motion[~status] = np.nan
+
+    # boxes with no tracked points get a zero shift
+    with np.errstate(all='ignore'):
+        shift = np.nan_to_num(np.nanmedian(motion, axis=1))
+
+    return xyxy + np.tile(shift, 2)
+
+
+def clip_boxes(xyxy, w, h, min_size=1.):
+    """
+    Clips the boxes to a frame of width w and height h.
+
+    Returns the clipped boxes and which of them are at least min_size pixels wide and high,
+    smaller ones left the frame and would give empty crops.
+    """
+    xyxy = np.clip(xyxy, 0, [w, h, w, h])
+    keep = (xyxy[:, 2] - xyxy[:, 0] >= min_size) & (xyxy[:, 3] - xyxy[:, 1] >= min_size)
+
+    return xyxy, keep
+
+
+class BoxPropagator:
+    """
+    Follows the detections of the last detected frame on the frames that are not detected.
+
+    Called on every frame with the detections of the frame, or None if the frame
+    was not detected. The boxes of the last detections are moved with the optical
+    flow between consecutive frames, so the tracker keeps getting detections on
+    the frames in between. The moved boxes are clipped to the frame and the ones
+    that left it are dropped. The optical flow is computed on frames resized by scale.
+    """
+
+    def __init__(self, scale=0.5):
+        self.scale = scale
+        self.prev_gray = None
+        self.last = None
+
+    def __call__(self, frame, detections):
+        small = cv2.resize(frame, None, fx=self.scale, fy=self.scale)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        if detections is None and self.last is not None:
+            h, w = frame.shape[:2]
+            detections = []
+            for last in self.last:
+                moved = last[:]
+                moved.xyxy, keep = clip_boxes(propagate_boxes(
+                    self.prev_gray, gray, last.xyxy * self.scale) / self.scale, w, h)
+                detections.append(moved[keep])
+
+        self.prev_gray = gray
+        self.last = detections
+
+        return detections
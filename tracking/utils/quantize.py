@@ -0,0 +1,125 @@
+import os
+import sys
+import argparse
+import supervision as sv
+
+import torch
+
+cdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(cdir)
+from backend import export_onnx, quantized_path
+from homography import WEIGHTS_KP, WEIGHTS_LINE, frame_tensor, load_models
+
+
+def calibration_frames(clip_paths, num_frames=100):
+    """
+    Returns num_frames model inputs spread evenly over the clips.
+    """
+    per_clip = -(-num_frames // len(clip_paths))
+
+    inputs = []
+    for clip_path in clip_paths:
+        video_info = sv.VideoInfo.from_video_path(clip_path)
+        stride = max(1, video_info.total_frames // per_clip)
+
+        frame_generator = sv.get_video_frames_generator(clip_path, stride=stride)
+        for frame, _ in zip(frame_generator, range(per_clip)):
+            inputs.append(frame_tensor(frame).numpy())
+
+    return inputs[:num_frames]
+
+
+class FramesReader:
+    """
+    Feeds the calibration frames to the ONNX Runtime quantizer one at a time.
+    """
+
+    def __init__(self, inputs, input_name='input'):
+        self.inputs = iter(inputs)
+        self.input_name = input_name
+
+    def get_next(self):
+        x = next(self.inputs, None)
+        return None if x is None else {self.input_name: x}
+
+    def rewind(self):
+        pass
+
+
+def quantize(weights_path, model, inputs, method='static'):
+    """
+    Builds the INT8 graph of the model next to its weights.
+
+    The 'static' method quantizes the weights and the activations, with the ranges of
+    the activations measured on the inputs. The 'dynamic' method only quantizes the weights
+    ahead of time and the activations on the fly, so it does not need inputs.
+    """
+    from onnxruntime.quantization import (
+        QuantFormat, QuantType, quantize_dynamic, quantize_static)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    onnx_path = f'{weights_path}.onnx'
+    if not os.path.exists(onnx_path):
+        export_onnx(model, onnx_path)
+
+    # fold the constants and infer the shapes so more of the graph can be quantized
+    prepared_path = f'{weights_path}.prep.onnx'
+    quant_pre_process(onnx_path, prepared_path)
+
+    if method == 'dynamic':
+        quantize_dynamic(
+            prepared_path,
+            quantized_path(weights_path),
+            weight_type=QuantType.QInt8,
+        )
+    else:
+        quantize_static(
+            prepared_path,
+            quantized_path(weights_path),
+            FramesReader(inputs),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+
+    os.remove(prepared_path)
+
+
+def quantize_models(clip_paths, num_frames=100, method='static'):
+    """
+    Builds the INT8 graphs of the keypoint and line models using frames from the clips.
+    """
+    model, model_l = load_models(torch.device('cpu'))
+    inputs = calibration_frames(clip_paths, num_frames) if method == 'static' else []
+
+    quantize(WEIGHTS_KP, model, inputs, method=method)
+    quantize(WEIGHTS_LINE, model_l, inputs, method=method)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the INT8 calibration models')
+
+    parser.add_argument(
+        '--clip_paths',
+        type=str,
+        nargs='+',
+        default=[f'{cdir}/../../results/trimmed/trimmed.mp4'],
+        help='Paths to the video clips the calibration frames are taken from',
+    )
+    parser.add_argument(
+        '--num_frames',
+        type=int,
+        default=100,
+        help='Number of calibration frames',
+    )
+    parser.add_argument(
+        '--method',
+        type=str,
+        default='static',
+        choices=['static', 'dynamic'],
+        help='Quantize the activations with calibration frames or on the fly',
+    )
+
+    args = parser.parse_args()
+    quantize_models(args.clip_paths, num_frames=args.num_frames, method=args.method)
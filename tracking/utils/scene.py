@@ -0,0 +1,67 @@
+import os
+import sys
+import cv2
+
+cdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(cdir)
+from motion import pitch_mask, frame_histogram
+
+
+class SceneClassifier:
+    """
+    Tells the frames showing the live pitch from the close-ups, replays, crowd shots and graphics.
+
+    A frame shows the pitch if at least min_green of it is green pitch. A frame is a cut
+    if its hue and saturation histogram correlates with the previous frame less than
+    cut_threshold. Both are computed on the frame resized by scale, so the classifier
+    costs much less than any of the models.
+    """
+
+    def __init__(self, min_green=0.3, cut_threshold=0.7, scale=0.25):
+        self.min_green = min_green
+        self.cut_threshold = cut_threshold
+        self.scale = scale
+
+        self.prev_hist = None
+
+        self.pitch_frames = 0
+        self.other_frames = 0
+        self.cuts = 0
+
+    def __call__(self, frame):
+        """
+        Returns whether the frame shows the pitch and whether it is the first frame of a new shot.
+        """
+        small = cv2.resize(frame, None, fx=self.scale, fy=self.scale)
+
+        green = (pitch_mask(small) > 0).mean()
+        pitch = bool(green >= self.min_green)
+
+        hist = frame_histogram(small)
+        cut = self.prev_hist is not None and \
+            cv2.compareHist(self.prev_hist, hist, cv2.HISTCMP_CORREL) < self.cut_threshold
+        self.prev_hist = hist
+
+        self.pitch_frames += pitch
+        self.other_frames += not pitch
+        self.cuts += cut
+
+        return pitch, bool(cut)
+
+    def histogram(self, frame):
+        """
+        Returns the histogram the next frame is compared to if frame is the last one classified.
+        """
+        return frame_histogram(cv2.resize(frame, None, fx=self.scale, fy=self.scale))
+
+    def report(self):
+        """
+        Returns the number of pitch frames, other frames and cuts.
+        """
+        frames = self.pitch_frames + self.other_frames
+        rate = self.other_frames / frames if frames else 0.
+
+        return (
+            f'Scenes: {self.pitch_frames} pitch frames, {self.other_frames} other frames '
+            f'({rate:.0%} skipped), {self.cuts} cuts'
+        )
@@ -1,17 +1,19 @@
-from typing import Generator, Iterable, List, TypeVar
+from typing import Generator, Iterable, List, Tuple, TypeVar
 
+import cv2
 import numpy as np
 import supervision as sv
 import torch
-import umap
 from sklearn.cluster import KMeans
 from tqdm import tqdm
-from transformers import AutoProcessor, SiglipVisionModel
 
 V = TypeVar("V")
 
 SIGLIP_MODEL_PATH = 'google/siglip-base-patch16-224'
 
+# size the torso of every crop is resized to for the color features
+TORSO_SIZE = 16
+
 
 def create_batches(
     sequence: Iterable[V], batch_size: int
@@ -38,30 +40,132 @@ def create_batches(
         yield current_batch
 
 
+def color_features(crops: List[np.ndarray], hue_bins: int = 18, value_bins: int = 4) -> np.ndarray:
+    """
+    Extract color features from the torso of a list of image crops.
+
+    The torso is the middle of the upper half of the crop, which keeps the shirt
+    and leaves out the shorts, the legs and most of the pitch. All the torsos are
+    resized to the same size and converted to HSV at once, then every crop gets a
+    hue histogram of its colored pixels and a value histogram of its grey pixels,
+    so white and black shirts are separated too. Green pixels are ignored.
+
+    Args:
+        crops (List[np.ndarray]): List of image crops.
+        hue_bins (int): Number of bins of the hue histogram.
+        value_bins (int): Number of bins of the value histogram.
+
+    Returns:
+        np.ndarray: Normalized histograms as a numpy array.
+    """
+    torsos = []
+    for crop in crops:
+        h, w = crop.shape[:2]
+        torso = crop[int(0.15 * h):max(int(0.5 * h), 1), int(0.25 * w):max(int(0.75 * w), 1)]
+        if torso.size == 0:
+            torso = crop
+        torsos.append(cv2.resize(torso, (TORSO_SIZE, TORSO_SIZE), interpolation=cv2.INTER_AREA))
+
+    # stack the torsos into one tall image so they are converted in a single call
+    hsv = cv2.cvtColor(np.concatenate(torsos), cv2.COLOR_BGR2HSV)
+    hsv = hsv.reshape(len(crops), -1, 3).astype(int)
+    hue, saturation, value = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+
+    green = (hue >= 35) & (hue <= 85) & (saturation >= 40) & (value >= 40)
+    colored = (saturation >= 50) & (value >= 50) & ~green
+    grey = ~colored & ~green
+
+    # offset the bins of every crop so a single bincount builds all the histograms
+    offsets = np.arange(len(crops))[:, None]
+    hue_bin = hue * hue_bins // 180
+    value_bin = value * value_bins // 256
+
+    hue_hist = np.bincount(
+        (offsets * hue_bins + hue_bin)[colored],
+        minlength=len(crops) * hue_bins,
+    ).reshape(len(crops), hue_bins)
+    value_hist = np.bincount(
+        (offsets * value_bins + value_bin)[grey],
+        minlength=len(crops) * value_bins,
+    ).reshape(len(crops), value_bins)
+
+    features = np.concatenate([hue_hist, value_hist], axis=1).astype(np.float32)
+    total = features.sum(axis=1, keepdims=True)
+
+    return features / np.maximum(total, 1)
+
+
 class TeamClassifier:
     """
-    A classifier that uses a pre-trained SiglipVisionModel for feature extraction,
-    UMAP for dimensionality reduction, and KMeans for clustering.
+    A classifier that separates the players into two teams with KMeans.
+
+    The 'siglip' backend uses a pre-trained SiglipVisionModel for feature extraction
+    and UMAP for dimensionality reduction. The 'color' backend uses histograms of
+    the shirt colors, which is much cheaper and does not load any model.
     """
 
-    def __init__(self, device: str = 'cpu', batch_size: int = 32, verbose: bool = False):
+    def __init__(self, device: str = 'cpu', batch_size: int = 32, verbose: bool = False, backend: str = 'siglip'):
         """
        Initialize the TeamClassifier with device and batch size.
 
        Args:
            device (str): The device to run the model on ('cpu' or 'cuda').
            batch_size (int): The batch size for processing images.
+           backend (str): The features to cluster ('siglip' or 'color').
        """
+        if backend not in ['siglip', 'color']:
+            raise ValueError(f'Unknown team classifier backend: {backend}')
+
         self.device = device
         self.batch_size = batch_size
         self.verbose = verbose
-        self.features_model = SiglipVisionModel.from_pretrained(
-            SIGLIP_MODEL_PATH).to(device)
-        self.processor = AutoProcessor.from_pretrained(SIGLIP_MODEL_PATH)
-        self.reducer = umap.UMAP(n_components=3)
+        self.backend = backend
         self.cluster_model = KMeans(n_clusters=2)
 
+        # the SigLIP model and UMAP are only imported when they are used
+        if backend == 'siglip':
+            import umap
+            from transformers import AutoProcessor, SiglipVisionModel
+
+            self.features_model = SiglipVisionModel.from_pretrained(
+                SIGLIP_MODEL_PATH).to(device)
+            self.processor = AutoProcessor.from_pretrained(SIGLIP_MODEL_PATH)
+            self.reducer = umap.UMAP(n_components=3)
+
+    def __getstate__(self) -> dict:
+        """
+        Keep the fitted reducer and clusters, the SigLIP model is loaded again instead.
+        """
+        state = self.__dict__.copy()
+        state.pop('features_model', None)
+        state.pop('processor', None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if self.backend == 'siglip':
+            from transformers import AutoProcessor, SiglipVisionModel
+
+            self.features_model = SiglipVisionModel.from_pretrained(
+                SIGLIP_MODEL_PATH).to(self.device)
+            self.processor = AutoProcessor.from_pretrained(SIGLIP_MODEL_PATH)
+
     def extract_features(self, crops: List[np.ndarray]) -> np.ndarray:
+        """
+        Extract features from a list of image crops using the backend.
+
+        Args:
+            crops (List[np.ndarray]): List of image crops.
+
+        Returns:
+            np.ndarray: Extracted features as a numpy array.
+        """
+        if self.backend == 'color':
+            return color_features(crops)
+
+        return self.extract_siglip_features(crops)
+
+    def extract_siglip_features(self, crops: List[np.ndarray]) -> np.ndarray:
         """
         Extract features from a list of image crops using the pre-trained
             SiglipVisionModel.
@@ -94,8 +198,9 @@ class TeamClassifier:
             crops (List[np.ndarray]): List of image crops.
         """
         data = self.extract_features(crops)
-        projections = self.reducer.fit_transform(data)
-        self.cluster_model.fit(projections)
+        if self.backend == 'siglip':
+            data = self.reducer.fit_transform(data)
+        self.cluster_model.fit(data)
 
     def predict(self, crops: List[np.ndarray]) -> np.ndarray:
         """
@@ -111,5 +216,111 @@ class TeamClassifier:
             return np.array([])
 
         data = self.extract_features(crops)
-        projections = self.reducer.transform(data)
-        return self.cluster_model.predict(projections)
+        if self.backend == 'siglip':
+            data = self.reducer.transform(data)
+        return self.cluster_model.predict(data)
+
+
+class TeamCache:
+    """
+    Remembers the team of each tracker id so that players are not classified on every frame.
+
+    A tracker id is classified on its first appearances and the predictions are
+    counted as votes. Once it has min_votes votes and the majority holds at least
+    min_agreement of them, the team is frozen and only checked again every
+    refresh frames. A check that disagrees with the frozen team unfreezes it and
+    drops its votes, since the tracker id may have switched to another player.
+    """
+
+    def __init__(self, min_votes: int = 5, min_agreement: float = 0.8, refresh: int = 250):
+        """
+        Initialize the TeamCache.
+
+        Args:
+            min_votes (int): Number of predictions before a team can be frozen.
+            min_agreement (float): Fraction of the votes the majority needs to freeze the team.
+            refresh (int): Number of frames after which a frozen team is checked again.
+        """
+        self.min_votes = min_votes
+        self.min_agreement = min_agreement
+        self.refresh = refresh
+
+        self.frame = 0
+        self.votes = {}
+        self.frozen = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, tracker_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Look up the teams of the tracker ids of a frame.
+
+        Args:
+            tracker_ids (np.ndarray): Tracker ids of the players in the frame.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The cached teams and a mask of the
+                tracker ids that need to be classified.
+        """
+        self.frame += 1
+
+        labels = np.zeros(len(tracker_ids), dtype=int)
+        missing = np.ones(len(tracker_ids), dtype=bool)
+
+        for i, tracker_id in enumerate(tracker_ids):
+            if tracker_id not in self.frozen:
+                continue
+
+            label, frozen_at = self.frozen[tracker_id]
+            if self.frame - frozen_at < self.refresh:
+                labels[i] = label
+                missing[i] = False
+
+        self.hits += int((~missing).sum())
+        self.misses += int(missing.sum())
+
+        return labels, missing
+
+    def update(self, tracker_ids: np.ndarray, predictions: np.ndarray) -> np.ndarray:
+        """
+        Add the predictions of the classifier as votes.
+
+        Args:
+            tracker_ids (np.ndarray): Tracker ids that were classified.
+            predictions (np.ndarray): Predicted team of each tracker id.
+
+        Returns:
+            np.ndarray: Team of each tracker id by majority vote.
+        """
+        labels = []
+        for tracker_id, prediction in zip(tracker_ids, predictions):
+            frozen = self.frozen.get(tracker_id)
+            if frozen is not None and frozen[0] != int(prediction):
+                # the votes of the old player would keep the wrong team for as many frames again
+                self.frozen.pop(tracker_id)
+                self.votes.pop(tracker_id)
+
+            votes = self.votes.setdefault(tracker_id, np.zeros(2, dtype=int))
+            votes[int(prediction)] += 1
+
+            label = int(votes.argmax())
+            agreement = votes[label] / votes.sum()
+
+            if votes.sum() >= self.min_votes and agreement >= self.min_agreement:
+                self.frozen[tracker_id] = (label, self.frame)
+            else:
+                self.frozen.pop(tracker_id, None)
+
+            labels.append(label)
+
+        return np.array(labels, dtype=int)
+
+    def report(self) -> str:
+        """
+        Returns the number of cache hits and misses.
+        """
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.
+
+        return f'Team cache: {self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)'
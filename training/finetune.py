@@ -6,6 +6,10 @@ from ultralytics import YOLO
 EPOCHS = 10
 BATCH = 4
 AMP = True  # set to False for GTX cards
+IMGSZ = 640  # raise to 1280 for a combined model so the ball is not lost when the frame is shrunk
+
+# path the finetuned model is saved to
+OUTPUT = '../models/players.pt'  # set to '../models/combined.pt' for a combined model
 
 
 # main function to fine-tune the YOLO model
@@ -17,10 +21,11 @@ if __name__ == '__main__':
         epochs=EPOCHS,
         batch=BATCH,
         amp=AMP,
+        imgsz=IMGSZ,
     )
 
     # save the best weights to the models folder
     shutil.copy(
         'runs/detect/train/weights/best.pt',
-        '../models/players.pt',
+        OUTPUT,
     )
@@ -13,6 +13,7 @@ import subprocess as sp
 import pickle
 sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
 import analytics.integration as analytics
+from tracking.store import load
 
 if os.name == 'nt':
     python_exec = 'python'
@@ -33,14 +34,13 @@ def load_file_data(filename, force_reload = False):
     print("attempting to access", filename, cvid)
     cvid = filename
     try:
-        with open(f"{cdir}/media-videos/outputs/{filename}/tracking_data.pkl", 'rb') as f:
-            tracking_data = pickle.load(f)
-            # tracking_data[1] is of the format [([(id, class, (x , y))], coordinates)]
-            view_data_2d = []
-            tracking_data_2d = []
-            for frame in tracking_data[1]:
-                tracking_data_2d.append([(int(t[0]), int(t[1]), (float(t[2][0]), float(t[2][1]))) for t in frame[0]])
-                view_data_2d.append([(float(t[0]), float(t[1])) for t in frame[1]])
+        tracking_data = load(f"{cdir}/media-videos/outputs/{filename}/tracking_data.pkl")
+        # tracking_data[1] is of the format [([(id, class, (x , y))], coordinates)]
+        view_data_2d = []
+        tracking_data_2d = []
+        for frame in tracking_data[1]:
+            tracking_data_2d.append([(int(t[0]), int(t[1]), (float(t[2][0]), float(t[2][1]))) for t in frame[0]])
+            view_data_2d.append([(float(t[0]), float(t[1])) for t in frame[1]])
 
         with open(f"{cdir}/media-videos/outputs/{filename}/analytics.pkl", 'rb') as f:
             analytics_data = pickle.load(f)